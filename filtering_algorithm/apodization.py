@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from scipy.fft import fft, fft2
+
+
+def edge_window(n, perct):
+    """
+    Window of n samples rising from 0 to 1 with a raised cosine over the
+    first perct % of the samples and falling back symmetrically at the end.
+    """
+    smooth = int(n*perct/100)   # width of the edge
+    w = np.ones(n)
+    i = np.arange(smooth)
+    w[:smooth] = (1-np.cos(np.pi*i/smooth))/2
+    w[n-smooth:n] = (w[1:smooth+1])[::-1]
+    return w
+
+
+class Apodization:
+    """
+    Single-pass apodization of a (tdim, ydim, xdim) cube:
+    ima -> (ima - av)*w + av, with w the temporal edge window (ap=1) or
+    the temporal times the spatial edge windows (ap=2) and av the mean of
+    the whole cube.
+
+    av is only known after the last frame, so apply() returns ima*w while
+    accumulating the mean (frames are read once), and the missing term
+    av*(1 - w) is added afterwards to the spectrum, where it is a single
+    pixel per temporal frequency (ap=1) or a separable product (ap=2); see
+    correct().
+    """
+    def __init__(self, tdim, ydim, xdim, ap=1, perct=10, dtype=np.float32):
+        if ap not in (1, 2):
+            raise ValueError('The ap values alowed are 0 (none), 1 (time) and 2 (time and space)')
+        self.dtype = np.dtype(dtype)
+        self.shape = (tdim, ydim, xdim)
+        self.wt = edge_window(tdim, perct)
+        self.wxy = None
+        if ap == 2:
+            self.wxy = np.outer(edge_window(ydim, perct), edge_window(xdim, perct))
+        self._wt = self.wt.astype(self.dtype)
+        self._wxy = None if self.wxy is None else self.wxy.astype(self.dtype)
+        self.total = 0.
+        self.count = 0
+
+    def apply(self, n, ima):
+        """
+        Window the n-th (0-based) frame and add it to the running mean.
+        """
+        ima = np.asarray(ima, dtype=self.dtype)
+        self.total += ima.sum(dtype=np.float64)
+        self.count += ima.size
+        ima = ima*self._wt[n]
+        if self._wxy is not None:
+            ima *= self._wxy
+        return ima
+
+    @property
+    def mean(self):
+        return self.total/self.count
+
+    def correct(self, spec, temporal_norm="ortho", mean=None):
+        """
+        Add av*(1 - w) to the spectrum spec of the windowed frames, in place.
+
+        spec holds the temporal frequencies 0..len(spec)-1 (all of them, or
+        the Hermitian half of a real transform) of a transform with
+        orthonormal spatial FFTs and temporal FFT normalized as
+        temporal_norm ("ortho" in-core, "backward" for BigNFFT).
+        """
+        av = self.mean if mean is None else mean
+        tdim, ydim, xdim = self.shape
+        wt_hat = fft(self.wt, norm=temporal_norm)[:len(spec)]
+        ones_t = np.sqrt(tdim) if temporal_norm == "ortho" else float(tdim)
+        ones_xy = np.sqrt(ydim*xdim)
+        if self.wxy is None:
+            # av*(1 - w_t) is constant in space: only the (0, 0) pixel changes
+            for k in range(len(spec)):
+                spec[k, 0, 0] += spec.dtype.type(av*ones_xy*(ones_t*(k == 0) - wt_hat[k]))
+            return spec
+        wxy_hat = fft2(self.wxy, norm="ortho")
+        for k in range(len(spec)):
+            term = -av*wt_hat[k]*wxy_hat
+            if k == 0:
+                term[0, 0] += av*ones_t*ones_xy
+            spec[k] += term.astype(spec.dtype)
+        return spec
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# benchmark.py
+"""
+Reproducible benchmark of bigsonic / BigNFFT on synthetic cubes.
+
+Every combination of cube size, mode, precision, workspace store,
+batch_size, block size, number of workers and checkpointing is run once
+through bigsonic itself (with an Instrument); for each stage
+the wall time, peak RSS and bytes read/written from storage are recorded
+(plus the bytes the disk-mode workspace takes on disk) and the whole
+sweep is written as JSON, so results from two commits can be compared
+with --compare.
+
+    python benchmark.py --sizes 80x256x256 160x512x512 --workers 1 4
+    python benchmark.py --modes disk --stores memmap zarr hdf5
+    python benchmark.py --checkpoints 0 1
+    python benchmark.py --compare old.json new.json
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import time
+import numpy as np
+import scipy
+
+from bigsonic_hmi import bigsonic, t_step
+from checkpoint import StageCache
+from instrumentation import Instrument
+
+
+def synthetic_cube(tdim, ydim, xdim, seed=0):
+    """
+    Float32 cube of plane-wave p-mode-like oscillations (~3 mHz) over a
+    slowly evolving pattern plus noise, at the HMI 45 s cadence.
+    """
+    rng = np.random.default_rng(seed)
+    t = (np.arange(tdim) * t_step)[:, None, None]
+    y = np.arange(ydim)[None, :, None]
+    x = np.arange(xdim)[None, None, :]
+    cube = np.full((tdim, ydim, xdim), 1000., dtype=np.float32)
+    for nu, kx, ky in ((3.3e-3, 1/20., 0.), (2.9e-3, 0., 1/24.), (3.7e-3, 1/30., 1/30.)):
+        cube += (30*np.sin(2*np.pi*(nu*t + kx*x + ky*y))).astype(np.float32)
+    cube += (20*np.cos(2*np.pi*(t/2700. + y/16.))).astype(np.float32)
+    cube += rng.normal(0, 2, cube.shape).astype(np.float32)
+    return cube
+
+
+def relative_rms(result, reference):
+    """
+    rms of result - reference in units of the standard deviation of
+    reference (the figure checked by the *_verification.py scripts).
+    """
+    diff = np.asarray(result, dtype=np.float64) - reference
+    return np.sqrt(np.mean(diff**2)) / np.std(reference)
+
+
+def collector(stages):
+    """
+    Instrument callback storing the end event of every stage in stages,
+    and the workspace metric as stages["workspace"].
+    """
+    def callback(event):
+        if event["event"] == "end":
+            stages[event["stage"]] = {"wall_s": round(event["duration_s"], 4),
+                                      "bytes": event["bytes"],
+                                      "peak_rss_bytes": event["peak_rss_bytes"],
+                                      "read_bytes": event["read_bytes"],
+                                      "write_bytes": event["write_bytes"]}
+        elif event["event"] == "metric" and event["stage"].endswith("workspace"):
+            stages["workspace"] = {"logical_bytes": event["logical_bytes"],
+                                   "disk_bytes": event["disk_bytes"]}
+    return callback
+
+
+def bench_disk(cube, path_tmp, bxdim, bydim, batch_size, workers, real, layout, precision,
+               prefetch, store, cache=None):
+    stages = {}
+    instrument = Instrument([collector(stages)])
+    tdim = cube.shape[0]
+    with instrument.stage("bigsonic_disk", cube.nbytes):
+        bigsonic(cube, 0, tdim-1, bxdim, bydim, path_tmp, mode="disk", real=real,
+                 batch_size=batch_size, workers=workers, instrument=instrument,
+                 precision=precision, prefetch=prefetch, store=store, layout=layout,
+                 cache=cache)
+    return stages
+
+
+def bench_incore(cube, path_tmp, bxdim, bydim, batch_size, workers, real, layout, precision,
+                 prefetch, store, cache=None):
+    stages = {}
+    instrument = Instrument([collector(stages)])
+    tdim = cube.shape[0]
+    with instrument.stage("bigsonic_incore", cube.nbytes):
+        bigsonic(cube, 0, tdim-1, bxdim, bydim, path_tmp, mode="incore", real=real,
+                 workers=workers, instrument=instrument, precision=precision, cache=cache)
+    return stages
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_sweep(args):
+    results = []
+    runners = {"disk": bench_disk, "incore": bench_incore}
+    for size in args.sizes:
+        tdim, ydim, xdim = (int(v) for v in size.split("x"))
+        cube = synthetic_cube(tdim, ydim, xdim, seed=args.seed)
+        for (mode, precision, store, real, layout, batch_size, block, workers,
+             prefetch, checkpoints) in itertools.product(
+                args.modes, args.precisions, args.stores, args.real, args.layouts,
+                args.batch_sizes, args.blocks, args.workers, args.prefetch,
+                args.checkpoints):
+            if mode == "incore" and (layout != args.layouts[0] or batch_size != args.batch_sizes[0]
+                                     or block != args.blocks[0] or prefetch != args.prefetch[0]
+                                     or store != args.stores[0]):
+                continue  # those parameters only affect the disk pipeline
+            if store != "memmap" and layout == "tiled":
+                continue  # chunked stores always use the frame layout
+            config = {"size": [tdim, ydim, xdim], "mode": mode, "precision": precision,
+                      "store": store,
+                      "real": bool(real),
+                      "layout": layout, "batch_size": batch_size, "block": block,
+                      "workers": workers, "prefetch": prefetch,
+                      "checkpoints": bool(checkpoints)}
+            print("Benchmark:", config)
+            t0 = time.perf_counter()
+            cache = StageCache(os.path.join(args.path_tmp, "cache")) if checkpoints else None
+            stages = runners[mode](cube, args.path_tmp, block, block, batch_size,
+                                   workers, bool(real), layout, precision, prefetch, store,
+                                   cache)
+            results.append({"config": config, "stages": stages,
+                            "total_s": round(time.perf_counter() - t0, 4)})
+            shutil.rmtree(args.path_tmp, ignore_errors=True)
+        del cube
+    meta = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "cpu_count": os.cpu_count(),
+            "machine": platform.machine()}
+    return {"meta": meta, "results": results}
+
+
+def compare(old_path, new_path, threshold):
+    """
+    Print the total time ratio new/old of every configuration in both files
+    and flag the ones slower than threshold.
+    """
+    with open(old_path) as f:
+        old = {json.dumps(r["config"], sort_keys=True): r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    regressions = 0
+    for r in new:
+        key = json.dumps(r["config"], sort_keys=True)
+        if key not in old:
+            continue
+        ratio = r["total_s"] / old[key]["total_s"]
+        flag = "  <-- regression" if ratio > threshold else ""
+        regressions += bool(flag)
+        print(f"{ratio:6.2f}x  {key}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["80x256x256"],
+                        help="cube sizes as TxYxX")
+    parser.add_argument("--modes", nargs="+", default=["disk", "incore"],
+                        choices=["disk", "incore"])
+    parser.add_argument("--precisions", nargs="+", default=["single"],
+                        choices=["single", "double"])
+    parser.add_argument("--stores", nargs="+", default=["memmap"],
+                        choices=["memmap", "zarr", "hdf5"],
+                        help="disk-mode workspace backend")
+    parser.add_argument("--real", nargs="+", type=int, default=[1], choices=[0, 1])
+    parser.add_argument("--layouts", nargs="+", default=["frame"],
+                        choices=["frame", "tiled"])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[8])
+    parser.add_argument("--blocks", nargs="+", type=int, default=[128],
+                        help="bxdim = bydim of the temporal subarrays")
+    parser.add_argument("--workers", nargs="+", type=int, default=[os.cpu_count() or 1])
+    parser.add_argument("--prefetch", nargs="+", type=int, default=[2],
+                        help="BigNFFT read-ahead/write-behind queue depth (0: sequential)")
+    parser.add_argument("--checkpoints", nargs="+", type=int, default=[0], choices=[0, 1],
+                        help="1: checkpoint every stage in a fresh StageCache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--path-tmp", default="benchmark_tmp/")
+    parser.add_argument("--output", default=None,
+                        help="JSON file (default benchmark_<commit>_<date>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="time ratio flagged as regression by --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        raise SystemExit(1 if compare(*args.compare, args.threshold) else 0)
+
+    report = run_sweep(args)
+    output = args.output or "benchmark_{}_{}.json".format(
+        report["meta"]["commit"] or "nogit",
+        datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("Resultados guardados en", output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,344 @@
 from pathlib import Path
 import numpy as np
-from scipy.fft import fft2, ifft2, fft, ifft
+from scipy.fft import fft2, ifft2, fft, ifft, rfft, irfft
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor
 import gc
+from instrumentation import stage
+from work_store import open_store, store_path, remove_store, disk_bytes
 import os
+import queue
+import threading
+
+def available_memory():
+    """
+    Bytes of physical memory currently available, or None if unknown.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def fits_in_memory(nbytes, fraction=0.8):
+    """
+    True if nbytes fit in the available physical memory (keeping a margin).
+    """
+    avail = available_memory()
+    return avail is not None and nbytes <= fraction * avail
+
+
+# (real, complex) dtypes of every precision mode
+PRECISIONS = {"single": (np.dtype(np.float32), np.dtype(np.complex64)),
+              "double": (np.dtype(np.float64), np.dtype(np.complex128))}
+
+
+def precision_dtypes(precision):
+    """
+    (real dtype, complex dtype) of precision "single" or "double".
+    """
+    try:
+        return PRECISIONS[precision]
+    except KeyError:
+        raise ValueError('The precisions alowed are "single" and "double"') from None
+
+
+_DONE = object()
+
+
+def pipelined(items, read, compute, write, depth=2):
+    """
+    write(item, compute(read(item))) for every item, with the reads running
+    ahead in a background thread and the writes behind in another one, so
+    I/O of the neighbouring items overlaps the compute of the current one.
+    At most depth items wait in each queue; depth=0 runs sequentially.
+    Exceptions of any of the three stages are raised in the caller.
+    """
+    if depth <= 0:
+        for item in items:
+            write(item, compute(read(item)))
+        return
+    read_q = queue.Queue(maxsize=depth)
+    write_q = queue.Queue(maxsize=depth)
+    errors = []
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                read_q.put((item, read(item)))
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            read_q.put(_DONE)
+
+    def writer():
+        while True:
+            job = write_q.get()
+            if job is _DONE:
+                return
+            if stop.is_set():
+                continue  # keep draining so the producer never blocks
+            try:
+                write(*job)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+    threads = [threading.Thread(target=reader, daemon=True),
+               threading.Thread(target=writer, daemon=True)]
+    for t in threads:
+        t.start()
+    try:
+        while not stop.is_set():
+            job = read_q.get()
+            if job is _DONE:
+                break
+            item, data = job
+            write_q.put((item, compute(data)))
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        if stop.is_set():
+            while read_q.get() is not _DONE:
+                pass
+        write_q.put(_DONE)
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+
 
 class BigNFFT:
     """
     Efficient N-dimensional FFT processor for large image cubes.
+
+    All stages work in place on a single memory-mapped complex workspace
+    (work/cube_memmap.dat) allocated with allocate(tdim): frames are
+    written with write_frame, transformed with run(pm=-1), the spectrum
+    can be modified through self.cube (tdim frequencies, or nspec =
+    tdim//2+1 with real=True), transformed back with run(pm=1) and read
+    with read_frame.
+
+    With real=True the input frames are real and only the Hermitian half
+    of the temporal axis is kept. Two consecutive real frames are packed
+    in one complex frame (2m -> real part, 2m+1 -> imaginary part), so the
+    packed input and the half spectrum share the same file and every
+    subarray is transformed in place.
+
+    layout selects how the temporal FFT reads the workspace: "frame" reads
+    every (T, by, bx) box straight from the frame-major file (strided
+    access), "tiled" first transposes the file, in chunks of frames, into
+    work/cube_tiles.dat where the time series of each subarray are stored
+    contiguously, and transposes back afterwards. "auto" uses "tiled" when
+    the workspace does not fit in the available memory.
+
+    precision "single" keeps the workspace and every FFT temporary in
+    complex64/float32, "double" in complex128/float64.
+
+    The spatial FFT and the tiled transposes stream the workspace through
+    pipelined(): the next batch is read and the previous one written in
+    background threads while the current one is transformed. prefetch is
+    the depth of the read and write queues (0: sequential) and
+    max_buffer_bytes, if given, caps the memory held by queued batches
+    (the depth is reduced to fit).
+
+    store selects the workspace backend (work_store.open_store): "memmap"
+    (raw file, the default), or "zarr" / "hdf5", compressed with blosc/zstd
+    (level clevel, byte shuffle if shuffle) in chunks of (batch_size,
+    bydim, bxdim), i.e. aligned to both the spatial batches and the
+    temporal subarrays, so a chunked store needs no tiled layout. Frames
+    written or read one by one are grouped into whole chunks in memory;
+    call flush() before touching self.cube after write_frame.
+
+    instrument (instrumentation.Instrument) receives the spatial_fft,
+    temporal_fft and transpose_* stage events.
     """
-    def __init__(self, dimx, dimy, bxdim, bydim, path_tmp, batch_size=8):
+    def __init__(self, dimx, dimy, bxdim, bydim, path_tmp, batch_size=8, real=False,
+                 layout="auto", chunk_bytes=2**28, workers=None, instrument=None,
+                 precision="single", prefetch=2, max_buffer_bytes=None,
+                 store="memmap", clevel=3, shuffle=True):
         self.dimx = dimx
         self.dimy = dimy
-        self.bxdim = bxdim
-        self.bydim = bydim
+        self.bxdim = int(bxdim)
+        self.bydim = int(bydim)
         self.path_tmp = Path(path_tmp)
         self.batch_size = batch_size
+        self.real = real
         self.str0 = self.path_tmp / "work"
         self.str0.mkdir(parents=True, exist_ok=True)
+        self.xdim = dimx - dimx % 2
+        self.ydim = dimy - dimy % 2
+        self.tdim = None
+        self.nspec = None
+        self.cube = None
+        self.cube_path = self.str0 / "cube_memmap.dat"
+        self.tiles_path = self.str0 / "cube_tiles.dat"
+        if layout not in ("auto", "frame", "tiled"):
+            raise ValueError('The layouts alowed are "auto", "frame" and "tiled"')
+        self.layout = layout
+        self.chunk_bytes = chunk_bytes
+        self.workers = workers  # threads for the subarrays and scipy.fft (None: all)
+        self.instrument = instrument  # instrumentation.Instrument or None
+        self.precision = precision
+        self.rdtype, self.cdtype = precision_dtypes(precision)
+        self.prefetch = prefetch
+        self.max_buffer_bytes = max_buffer_bytes
+        self.store = store
+        self.clevel = clevel
+        self.shuffle = shuffle
+        self._wbuf = None  # (first frame, frames) pending write to a chunked store
+        self._rbuf = None  # (first frame, frames) last chunk read from it
+
+    def allocate(self, tdim):
+        """
+        Preallocate the workspace for tdim frames.
+        """
+        if self.real and tdim % 2 != 0:
+            raise ValueError("real=True needs an even number of frames")
+        self.tdim = tdim
+        self.nspec = tdim // 2 + 1 if self.real else tdim
+        name = "cube_memmap" if self.store == "memmap" else "cube"
+        self.cube = open_store(self.store, self.str0 / name, (self.nspec, self.ydim, self.xdim),
+                               self.cdtype, (self.batch_size, self.bydim, self.bxdim),
+                               clevel=self.clevel, shuffle=self.shuffle)
+        self.cube_path = store_path(self.cube)
+        if self.store != "memmap":
+            self.layout = "frame"  # the chunks already keep every subarray contiguous
+        if self.layout == "auto":
+            self.layout = "frame" if fits_in_memory(self.cube.nbytes) else "tiled"
+        return self.cube
+
+    def write_frame(self, idx, ima):
+        """
+        Store the idx-th (real) frame of the cube in the workspace.
+        """
+        ima = ima[:self.ydim, :self.xdim]
+        if not isinstance(self.cube, np.memmap):
+            self._write_buffered(idx, ima)
+        elif self.real:
+            if idx % 2 == 0:
+                self.cube[idx // 2].real = ima
+            else:
+                self.cube[idx // 2].imag = ima
+        else:
+            self.cube[idx] = ima
+
+    def _write_buffered(self, idx, ima):
+        k = idx // 2 if self.real else idx
+        g0 = k - k % self.batch_size
+        if self._wbuf is None or self._wbuf[0] != g0:
+            self.flush()
+            self._wbuf = (g0, np.array(self.cube[g0:g0 + self.batch_size]))
+        frames = self._wbuf[1]
+        if not self.real:
+            frames[k - g0] = ima
+        elif idx % 2 == 0:
+            frames[k - g0].real = ima
+        else:
+            frames[k - g0].imag = ima
+
+    def flush(self):
+        """
+        Write pending buffered frames and flush the workspace to storage.
+        """
+        if self._wbuf is not None:
+            g0, frames = self._wbuf
+            self.cube[g0:g0 + len(frames)] = frames
+            self._wbuf = None
+        self._rbuf = None
+        if self.cube is not None:
+            self.cube.flush()
+
+    def disk_bytes(self):
+        """
+        Bytes the workspace currently takes on disk.
+        """
+        return disk_bytes(self.cube_path) if self.cube_path.exists() else 0
+
+    def read_frame(self, idx):
+        """
+        Real part of the idx-th frame of the workspace (float32 or float64).
+        """
+        k = idx // 2 if self.real else idx
+        if isinstance(self.cube, np.memmap):
+            frame = self.cube[k]
+        else:
+            g0 = k - k % self.batch_size
+            if self._rbuf is None or self._rbuf[0] != g0:
+                self._rbuf = (g0, self.cube[g0:g0 + self.batch_size])
+            frame = self._rbuf[1][k - g0]
+        if self.real:
+            return np.array(frame.imag if idx % 2 else frame.real)
+        return np.array(frame.real)
+
+    def close(self):
+        """
+        Release and remove the workspace file.
+        """
+        if self.cube is not None:
+            self.flush()
+            if hasattr(self.cube, "close"):
+                self.cube.close()
+            del self.cube
+            self.cube = None
+            gc.collect()
+        try:
+            remove_store(self.cube_path)
+        except Exception as e:
+            print(f"Could not remove memmap file: {e}")
+
+    def _depth(self, item_bytes):
+        """
+        Queue depth for items of item_bytes: prefetch, reduced so that the
+        2*depth queued items plus the one being processed fit the ceiling.
+        """
+        if self.max_buffer_bytes is None:
+            return self.prefetch
+        return max(0, min(self.prefetch, (self.max_buffer_bytes // max(1, item_bytes) - 1) // 2))
 
     def _process_subarray(self, args):
         cube, pm, miniy, maxiy, minix, maxix = args
-        box3d = cube[:, miniy:maxiy, minix:maxix]
+        if self.real:
+            tdim, half = self.tdim, self.tdim // 2
+            if pm == -1:
+                packed = cube[:half, miniy:maxiy, minix:maxix]
+                box3d = np.empty((tdim,) + packed.shape[1:], dtype=self.rdtype)
+                box3d[0::2] = packed.real
+                box3d[1::2] = packed.imag
+                cube[:, miniy:maxiy, minix:maxix] = rfft(box3d, axis=0)
+            elif pm == 1:
+                box3d = irfft(cube[:, miniy:maxiy, minix:maxix], n=tdim, axis=0)
+                packed = np.empty((half,) + box3d.shape[1:], dtype=self.cdtype)
+                packed.real = box3d[0::2]
+                packed.imag = box3d[1::2]
+                cube[:half, miniy:maxiy, minix:maxix] = packed
+            return
+        # private copy of the box, transformed in place (no second temporary)
+        box3d = np.array(cube[:, miniy:maxiy, minix:maxix])
         if pm == -1:
-            box3d = fft(box3d, axis=0)
+            box3d = fft(box3d, axis=0, overwrite_x=True)
         elif pm == 1:
-            box3d = ifft(box3d, axis=0)
+            box3d = ifft(box3d, axis=0, overwrite_x=True)
         cube[:, miniy:maxiy, minix:maxix] = box3d
 
-    def run(self, pm, first, last):
+    def _subarrays(self):
         """
-        Run the FFT/iFFT pipeline on the image cube.
+        Boxes (miniy, maxiy, minix, maxix) covering the (ydim, xdim) plane.
         """
-        xdim, ydim = self.dimx, self.dimy
+        xdim, ydim = self.xdim, self.ydim
         bxdim, bydim = self.bxdim, self.bydim
-        batch_size = self.batch_size
-
-        if xdim % 2 != 0: xdim -= 1
-        if ydim % 2 != 0: ydim -= 1
-
-        # Step 1: Batch FFT/iFFT
-        print('Reading images')
-        indices = np.arange(first, last + 1)
-        for batch_start in tqdm(range(0, len(indices), batch_size)):
-            batch_indices = indices[batch_start:batch_start + batch_size]
-            ims = []
-            for i in batch_indices:
-                dcn = str(i).zfill(4)
-                try:
-                    if pm == -1:
-                        im = np.load(self.str0 / f"apo{dcn}.npy")
-                        ims.append(im[:ydim, :xdim])
-                    elif pm == 1:
-                        im = np.load(self.str0 / f"fft{dcn}.npy")
-                        ims.append(im[:ydim, :xdim])
-                except Exception as e:
-                    print(f"Error loading {dcn}: {e}")
-            ims = np.stack(ims)
-            if pm == -1:
-                fims = fft2(ims, axes=(-2, -1), norm="ortho").astype(np.complex64)
-                for idx, i in enumerate(batch_indices):
-                    dcn = str(i).zfill(4)
-                    np.save(self.str0 / f"fft{dcn}.npy", fims[idx])
-            elif pm == 1:
-                fims = ifft2(ims, axes=(-2, -1), norm="ortho").astype(np.complex64)
-                for idx, i in enumerate(batch_indices):
-                    dcn = str(i).zfill(4)
-                    np.save(self.str0 / f"F{dcn}.npy", fims[idx])
-            del ims, fims
-            gc.collect()
-
-        # Step 2: Use memmap for the cube
-        tdim = last - first + 1
-        cube_path = self.str0 / "cube_memmap.dat"
-        cube = np.memmap(cube_path, dtype=np.complex64, mode='w+', shape=(tdim, ydim, xdim))
-        print("Loading all FFT images into memmap...")
-        for idx, i in enumerate(range(first, last + 1)):
-            dcn = str(i).zfill(4)
-            if pm == -1:
-                cube[idx] = np.load(self.str0 / f"fft{dcn}.npy")
-            elif pm == 1:
-                cube[idx] = np.load(self.str0 / f"F{dcn}.npy")
-        cube.flush()
-        gc.collect()
-
-        # Step 3: Process subarrays in memory (parallel)
         a = xdim % bxdim
         b = ydim % bydim
         n = xdim // bxdim
@@ -95,33 +348,135 @@ class BigNFFT:
         diy = np.full(m + (1 if b != 0 else 0), bydim, dtype=int)
         if b != 0: diy[-1] = b
         nelx, nely = len(dix), len(diy)
-        print("Number of subarrays -->", nelx * nely)
-        print('Processing subarrays in Fourier domain...')
-        tasks = []
+        boxes = []
         for jbox in range(nely):
             for ibox in range(nelx):
                 miniy = jbox * bydim
                 maxiy = miniy + diy[jbox]
                 minix = ibox * bxdim
                 maxix = minix + dix[ibox]
-                tasks.append((cube, pm, miniy, maxiy, minix, maxix))
-        with ThreadPoolExecutor() as executor:
-            list(tqdm(executor.map(self._process_subarray, tasks), total=len(tasks)))
-        cube.flush()
+                boxes.append((miniy, maxiy, minix, maxix))
+        return boxes
+
+    def _temporal(self, pm):
+        """
+        FFT/iFFT along time of every subarray of the workspace (parallel).
+        """
+        boxes = self._subarrays()
+        print("Number of subarrays -->", len(boxes))
+        print('Processing subarrays in Fourier domain...')
+        tasks = [(self.cube, pm) + box for box in boxes]
+        with stage(self.instrument, "temporal_fft", nbytes=self.cube.nbytes):
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(tqdm(executor.map(self._process_subarray, tasks), total=len(tasks)))
+            self.cube.flush()
         gc.collect()
 
-        # Step 4: Save updated FFT images back to disk
-        print("Saving updated FFT images...")
-        for idx, i in enumerate(range(first, last + 1)):
-            dcn = str(i).zfill(4)
+    def _temporal_tiled(self, pm):
+        """
+        Same as _temporal, through the time-contiguous tiled layout.
+
+        Each subarray is stored as one contiguous (nspec, by, bx) block of
+        work/cube_tiles.dat, so its temporal FFT streams a single block
+        instead of nspec strided reads. The transposes in and out read
+        and write the workspace in chunks of whole frames.
+        """
+        cube = self.cube
+        boxes = self._subarrays()
+        sizes = [(maxiy - miniy) * (maxix - minix) * self.nspec
+                 for miniy, maxiy, minix, maxix in boxes]
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        tiles = np.memmap(self.tiles_path, dtype=self.cdtype, mode='w+',
+                          shape=(int(offsets[-1]),))
+        views = [tiles[offsets[i]:offsets[i + 1]].reshape(self.nspec, maxiy - miniy, maxix - minix)
+                 for i, (miniy, maxiy, minix, maxix) in enumerate(boxes)]
+        frame_bytes = self.ydim * self.xdim * cube.itemsize
+        chunk = max(1, min(self.nspec, self.chunk_bytes // frame_bytes))
+
+        print("Number of subarrays -->", len(boxes))
+        depth = self._depth(chunk * frame_bytes)
+
+        def read_frames(t0):
+            return np.array(cube[t0:t0 + chunk])
+
+        def write_tiles(t0, frames):
+            for view, (miniy, maxiy, minix, maxix) in zip(views, boxes):
+                view[t0:t0 + chunk] = frames[:, miniy:maxiy, minix:maxix]
+
+        def read_tiles(t0):
+            frames = np.empty((min(chunk, self.nspec - t0), self.ydim, self.xdim), dtype=cube.dtype)
+            for view, (miniy, maxiy, minix, maxix) in zip(views, boxes):
+                frames[:, miniy:maxiy, minix:maxix] = view[t0:t0 + chunk]
+            return frames
+
+        def write_frames(t0, frames):
+            cube[t0:t0 + chunk] = frames
+
+        print('Transposing to tiled layout...')
+        with stage(self.instrument, "transpose_to_tiles", nbytes=cube.nbytes):
+            pipelined(tqdm(range(0, self.nspec, chunk)), read_frames, lambda frames: frames,
+                      write_tiles, depth=depth)
+
+        print('Processing subarrays in Fourier domain...')
+        tasks = [(view, pm, 0, view.shape[1], 0, view.shape[2]) for view in views]
+        with stage(self.instrument, "temporal_fft", nbytes=cube.nbytes):
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(tqdm(executor.map(self._process_subarray, tasks), total=len(tasks)))
+            tiles.flush()
+
+        print('Transposing back to frames...')
+        with stage(self.instrument, "transpose_to_frames", nbytes=cube.nbytes):
+            pipelined(tqdm(range(0, self.nspec, chunk)), read_tiles, lambda frames: frames,
+                      write_frames, depth=depth)
+            cube.flush()
+        del views, tiles
+        gc.collect()
+        os.remove(self.tiles_path)
+
+    def _spatial(self, pm):
+        """
+        Batch FFT2/iFFT2 of the frames of the workspace.
+        """
+        cube, batch_size = self.cube, self.batch_size
+        fft_workers = -1 if self.workers is None else self.workers
+        transform = fft2 if pm == -1 else ifft2
+
+        def read(batch_start):
+            return np.array(cube[batch_start:batch_start + batch_size])
+
+        def compute(frames):
+            return transform(frames, axes=(-2, -1), norm="ortho", workers=fft_workers,
+                             overwrite_x=True)
+
+        def write(batch_start, frames):
+            cube[batch_start:batch_start + batch_size] = frames
+
+        print('Transforming images')
+        with stage(self.instrument, "spatial_fft", nbytes=cube.nbytes):
+            pipelined(tqdm(range(0, len(cube), batch_size)), read, compute, write,
+                      depth=self._depth(batch_size * cube[0].nbytes))
+            cube.flush()
+        gc.collect()
+
+    def run(self, pm, first, last):
+        """
+        Run the FFT (pm=-1) or iFFT (pm=1) in place on the workspace.
+        """
+        tdim = last - first + 1
+        if self.cube is None:
+            raise RuntimeError("allocate() the workspace before running")
+        if tdim != self.tdim:
+            raise ValueError(f"Workspace holds {self.tdim} frames, not {tdim}")
+        self.flush()
+        temporal = self._temporal_tiled if self.layout == "tiled" else self._temporal
+        if self.real:
+            # Temporal rfft first so the spatial FFT only sees nspec frames
             if pm == -1:
-                np.save(self.str0 / f"fft{dcn}.npy", cube[idx])
+                temporal(pm)
+                self._spatial(pm)
             elif pm == 1:
-                np.save(self.str0 / f"F{dcn}.npy", cube[idx])
-        del cube
-        gc.collect()
-        # Optionally, remove the memmap file after use
-        try:
-            os.remove(cube_path)
-        except Exception as e:
-            print(f"Could not remove memmap file: {e}")
\ No newline at end of file
+                self._spatial(pm)
+                temporal(pm)
+        else:
+            self._spatial(pm)
+            temporal(pm)
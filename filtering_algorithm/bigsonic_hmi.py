@@ -11,8 +11,16 @@ import shutil
 import glob
 #~ import sunpy.map as smap
 import sys
-from bignfft_new import BigNFFT
+from bignfft_new import BigNFFT, fits_in_memory, available_memory, precision_dtypes
+from subsonic_mask import subsonic_mask, filter_slice, mask_key
+from scipy.fft import fftn, ifftn, rfftn, irfftn
 from tqdm import tqdm
+from instrumentation import metric, stage
+from checkpoint import make_key, input_key
+from cube_source import roi_view
+from work_store import open_store
+from output_sink import as_sink
+from apodization import Apodization
 
 
 print("Iniciando codigo bigsonic")
@@ -21,14 +29,97 @@ scale = 0.50404 #arcsec/pixel ; change manually
 t_step = 45 #Mean time separation between images [s] ; change manually
 v_ph = 4.0 # Maximum phase velocity [km/s]
 
-def bigsonic(cube,first,last,bxdim,bydim,path_tmp):
-    if not os.path.exists(path_tmp+"work"):
-        os.makedirs(path_tmp+"work")
-    if not os.path.exists(path_tmp+"filter"):
-        os.makedirs(path_tmp+"filter")
-        
+def incore_bytes(tdim, ydim, xdim, real=True, precision="single"):
+    """
+    Memory of the in-core path for a (tdim, ydim, xdim) cube: the spectrum
+    plus one FFT temporary and the real result.
+    """
+    rdtype, cdtype = precision_dtypes(precision)
+    if real:
+        return tdim*ydim*xdim*4*rdtype.itemsize
+    return tdim*ydim*xdim*(2*cdtype.itemsize + rdtype.itemsize)
+
+def bigsonic(cube,first,last,bxdim,bydim,path_tmp,mask_cache=None,mode="auto",real=True,
+             batch_size=8,workers=None,instrument=None,cache=None,precision="single",
+             roi=None,ap=0,prefetch=2,store="memmap",sink=None,layout="auto"):
+    """
+    Subsonic filtering of cube[first:last+1].
+
+    roi = (y0, y1, x0, x1) restricts the filtering to cube[:, y0:y1, x0:x1]:
+    only that hyperslab is read from the source (see cube_source.CubeView),
+    the Fourier grid and the mask are sized to it and the result has shape
+    (last-first+1, y1-y0, x1-x0) (cropped to even sizes).
+
+    mode = "incore": one multithreaded 3D FFT of the whole cube in RAM.
+    mode = "disk": out-of-core FFT through BigNFFT in path_tmp/work.
+    mode = "auto": "incore" when the cube fits in the available memory.
+    mode = "dask": chunked dask arrays on the active dask scheduler/cluster
+    (see dask_backend.bigsonic_dask); returns a dask array over the zarr
+    output path_tmp/filtered.zarr, or copies it to sink. The whole run is
+    one "dask" stage for instrument; cache, workers and real=False are
+    rejected (ValueError).
+
+    With real=True (the input is real) only the Hermitian half of the
+    temporal axis is transformed and filtered (rfftn/irfftn), which halves
+    the FFT work and the size of the spectrum.
+
+    workers is the number of FFT threads (None: all cores) and batch_size
+    the number of frames per spatial FFT batch in disk mode; prefetch is
+    the number of batches BigNFFT reads ahead / writes behind the FFT.
+    store is the disk-mode workspace backend: "memmap" (raw), "zarr" or
+    "hdf5" (chunked, blosc/zstd compressed; see work_store.open_store),
+    and layout how its temporal FFT reads it (see BigNFFT).
+
+    precision = "single" runs apodization, FFTs, filter and output in
+    float32/complex64 (no temporary is promoted), "double" in
+    float64/complex128. See precision_verification.py for the difference.
+
+    ap = 1 apodizes the cube in time, ap = 2 in time and at the spatial
+    edges (perct % raised-cosine edges around the cube mean, see
+    apodization.Apodization). The frames are read only once: the mean is
+    accumulated while reading and its contribution is added to the spectrum.
+
+    sink (output_sink.ArraySink, NpySink, FitsSink or ZarrSink) receives
+    the filtered frames as they come out of the inverse transform and
+    bigsonic returns sink.result(); by default (None) the cube is returned
+    as an array in memory.
+
+    instrument (instrumentation.Instrument) receives start/end events of
+    every stage: mask, read_frames, forward_fft, filter, inverse_fft and
+    assemble (plus checkpoint_* / restore_* with cache); in disk mode it
+    also gets a "workspace" metric with the logical and on-disk size of
+    the spectrum.
+
+    cache (checkpoint.StageCache) stores the apodized frames, the forward
+    spectrum and the filtered spectrum, keyed by a hash of the input and
+    the parameters each one depends on. A rerun resumes from the last
+    completed stage; changing only v_ph reuses the forward spectrum.
+    """
+    if mode not in ("auto", "incore", "disk", "dask"):
+        raise ValueError('The modes alowed are "auto", "incore", "disk" and "dask"')
+    if mode == "dask":
+        from dask_backend import bigsonic_dask
+        for name, value in (("cache", cache), ("workers", workers)):
+            if value is not None:
+                raise ValueError(f'{name} is not supported with mode="dask"')
+        if not real:
+            raise ValueError('mode="dask" always runs the real (rfft) path: real must be True')
+        with stage(instrument, "dask"):
+            cube_new = bigsonic_dask(cube, first, last, bxdim, bydim, path_tmp,
+                                     frame_chunk=batch_size, precision=precision,
+                                     mask_cache=mask_cache, roi=roi, ap=ap)
+        if sink is None:
+            return cube_new
+        with stage(instrument, "assemble", nbytes=cube_new.nbytes):
+            sink.open(cube_new.shape, cube_new.dtype, first)
+            for n in range(cube_new.shape[0]):
+                sink.write(first+n, np.asarray(cube_new[n]))
+            sink.close()
+        return sink.result()
+    rdtype, cdtype = precision_dtypes(precision)
+    cube = roi_view(cube, roi)
+    
     str0 = path_tmp+"work/"
-    strf = path_tmp+"filter/"
 
     
     # lineas editadas para que funcione con el cubo generado por Sunpy
@@ -64,16 +155,17 @@ def bigsonic(cube,first,last,bxdim,bydim,path_tmp):
     
     
     
-    ap = 0
-    
     cut = 1
     
     if (cut > 2) or (cut < 0):
         raise ValueError('The cut values alowed are 0, 1, and 2')
-    if (ap != 0) or (cut != 0):
-        perct = 10
-        smooth_t = int(tdim*perct/100) # width of the edge in t-dimension
+    perct = 10 # width of the taper/apodization edge [%]
 
+    if mode == "auto":
+        mode = "incore" if fits_in_memory(incore_bytes(tdim, ydim, xdim, real, precision)) else "disk"
+    print("Mode ->", mode, "| precision ->", precision)
+    frame_bytes = ydim*xdim*rdtype.itemsize
+    
     t1 = time.time()
     
     #-----------------------------------------
@@ -87,134 +179,177 @@ def bigsonic(cube,first,last,bxdim,bydim,path_tmp):
     print("Spatial resolution ->", scale, " arcsec/pixel")
     
     print("---")
-    
-    kx_step = 1./(scale*725.*xdim)
-    ky_step = 1./(scale*725.*ydim)
-    w_step = 1./(t_step*tdim)
-    
-    
-    # Prepare de filter
-    
-    nx = int(xdim/2) + 1
-    ny = int(ydim/2) + 1
-    nt = int(tdim/2) + 1
-    filter_mask = np.zeros([ny,nx,nt],dtype=float)
-    
-    
-    if (cut == 0) or (cut == 1):
-        print("Now calculatin' filter...")
-        for j in range(ny):
-            for i in range(nx):
-                k_by_v = np.sqrt((i*kx_step)**2+(j*ky_step)**2)*v_ph
-                for k in range(1,nt):
-                    if k*w_step <= k_by_v:
-                        filter_mask[j,i,k]=1.
-    
-    if cut == 1:
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(1,nt):
-                    if filter_mask[j,i,k] != 1:
-                        trans = perct*k/100
-                        trans2 = int(trans/2)
-                        trans = 2*trans
-                        if trans2 >= 1:
-                            n=0
-                            for kk in range(int(k-trans2),int(k+trans2)):
-                                if kk <= nt-1:
-                                    filter_mask[j,i,kk] = 0.5+0.5*np.cos(np.pi*n/trans)
-                                    n = n+1
-                                else:
-                                    continue
-    
-
-    
-    for i in range(nt):
-        filter_slice = np.zeros([ydim,xdim])
-        if i == 0:
-            filter_slice = filter_slice + 1.
-        else:
-            filter_slice[0:ny,0:nx]=filter_mask[:,:,i]
-            filter_slice[ny:ydim,:]=filter_slice[1:ny-1,:][::-1,:]
-            filter_slice[:,nx:xdim]=filter_slice[:,1:nx-1][:,::-1]
-        dcn = str(i).zfill(4)
-        np.save(strf+dcn+".npy",filter_slice)
-        
-        if i != 0:
-            dcn = str(tdim-i+first).zfill(4)
-            np.save(strf+dcn+".npy",filter_slice)
 
-    print("The filter was written to "+strf)
-    
-    del(filter_mask)
-    del(filter_slice)
-    
-    
-    if ap != 0:
-        tmask = np.ones(tdim)
-        for i in range(smooth_t):
-            tmask[i] = (1-np.cos(np.pi*i/smooth_t))/2
-        tmask[tdim-smooth_t:tdim] = (tmask[1:smooth_t+1])[::-1]
-        print('Computing the mean for the cube (it could take several minutes):')
-        av = 0.
-        for n in range(first,last+1):
-            ima = cube[n,:,:]
-            ima = ima[y_anf:y_anf+ydim,x_anf:x_anf+xdim]
-            av = av+np.mean(ima)/tdim
+
+    # Prepare de filter (only the non-negative quadrant, the full slices
+    # are rebuilt by mirror symmetry when the filter is applied)
+    
+    print("Now calculatin' filter...")
+    with stage(instrument, "mask"):
+        filter_mask = subsonic_mask((ydim, xdim, tdim), scale, t_step, v_ph,
+                                    perct=perct, cut=cut, cache_dir=mask_cache)
+    
+    
+    # Stage checkpoints: apodized frames -> forward spectrum -> filtered
+    # spectrum, each keyed by the input and the parameters it depends on
+    resume = None
+    if cache is not None:
+        key_apo = make_key("apo", input_key(cube, first, last), ydim, xdim, ap, perct,
+                           mode, real, precision)
+        key_fwd = make_key("forward", key_apo)
+        key_flt = make_key("filtered", key_fwd,
+                           mask_key((ydim, xdim, tdim), scale, t_step, v_ph, perct, cut))
+        keys = {"apo": key_apo, "apo_mean": key_apo, "forward": key_fwd, "filtered": key_flt}
+        for name in ("filtered", "forward", "apo"):
+            # the apodized frames are only usable together with their mean
+            if cache.has(name, keys[name]) and (name != "apo" or ap == 0
+                                                or cache.has("apo_mean", keys["apo_mean"])):
+                resume = name
+                print("Resuming from checkpoint ->", name)
+                break
+    
+    def checkpoint(name, data):
+        if cache is not None:
+            with stage(instrument, "checkpoint_"+name, nbytes=data.nbytes):
+                cache.save(name, keys[name], data)
+    
+    def restore(name, out=None):
+        with stage(instrument, "restore_"+name):
+            return cache.load(name, keys[name], out=out)
+    
+    
+    # windows applied while reading, mean term added to the spectrum
+    apod = Apodization(tdim, ydim, xdim, ap=ap, perct=perct, dtype=rdtype) if ap != 0 else None
+    av = None
     
     
     # Loop of reading, optional apodization and writing images
     
-    print('Reading apodization')
-    for n in tqdm(range(first,last+1)):
-        dcn = str(n).zfill(4)
-        
-        # Editado para trabajar con sunpy
-        
-        ima = cube[n,:,:]
-        ima = ima.astype('float32')
-        
-        # apodization
-        if ap != 0:
-            ima = ima-av
-            ima = ima*tmask[n-first]
-            ima = ima + av
-            del(tmask)
-        
-
-        np.save(str0+"apo"+dcn+".npy",ima)
-
-    
-    del(ima)
+    if mode == "incore":
+        if resume in (None, "apo"):
+            spec = np.empty([tdim,ydim,xdim],dtype=rdtype if real else cdtype)
+    else:
+        # single memory-mapped workspace shared by every out-of-core stage
+        nfft_processor = BigNFFT(dimx, dimy, bxdim, bydim, path_tmp, batch_size=batch_size,
+                                 real=real, workers=workers, prefetch=prefetch,
+                                 instrument=instrument, precision=precision, store=store,
+                                 layout=layout)
+        nfft_processor.allocate(tdim)
+        spec = nfft_processor.cube
+    
+    if resume is None:
+        print('Reading apodization')
+        with stage(instrument, "read_frames", nbytes=frame_bytes*tdim):
+            for n in tqdm(range(first,last+1)):
+            
+                # Editado para trabajar con sunpy
+            
+                ima = np.asarray(cube[n,:,:])[y_anf:y_anf+ydim,x_anf:x_anf+xdim]
+            
+                # apodization
+                if apod is not None:
+                    ima = apod.apply(n-first, ima)
+                else:
+                    ima = ima.astype(rdtype)
+            
+                if mode == "incore":
+                    spec[n-first] = ima[:ydim,:xdim]
+                else:
+                    nfft_processor.write_frame(n-first, ima)
+            if mode != "incore":
+                nfft_processor.flush()
+        del(ima)
+        if apod is not None:
+            av = apod.mean
+            checkpoint("apo_mean", np.array([av]))
+        checkpoint("apo", spec)
+    elif resume == "apo":
+        restore("apo", out=spec)
+        if apod is not None:
+            av = float(restore("apo_mean")[0])
+    
+    if mode == "incore":
+        # In-core 3D FFT, filter and inverse 3D FFT (no work directory)
+        fft_workers = -1 if workers is None else workers
+        if resume in (None, "apo"):
+            print("In-core FFT")
+            with stage(instrument, "forward_fft", nbytes=spec.nbytes):
+                if real:
+                    # the last axis in axes (time) keeps only its Hermitian half
+                    spec = rfftn(spec, axes=(1,2,0), norm="ortho", workers=fft_workers)
+                else:
+                    spec = fftn(spec, axes=(0,1,2), norm="ortho", workers=fft_workers, overwrite_x=True)
+                if apod is not None:
+                    apod.correct(spec, temporal_norm="ortho", mean=av)
+            checkpoint("forward", spec)
+        else:
+            spec = np.array(restore(resume))
+        if resume != "filtered":
+            print('applying filter')
+            with stage(instrument, "filter", nbytes=spec.nbytes):
+                for k in range(spec.shape[0]):
+                    spec[k] *= filter_slice(filter_mask, k, ydim, xdim, dtype=rdtype)
+            checkpoint("filtered", spec)
+        del(filter_mask)
+        with stage(instrument, "inverse_fft", nbytes=spec.nbytes):
+            if real:
+                cube_new = irfftn(spec, s=(ydim,xdim,tdim), axes=(1,2,0), norm="ortho",
+                                  workers=fft_workers, overwrite_x=True)
+            else:
+                spec = ifftn(spec, axes=(0,1,2), norm="ortho", workers=fft_workers, overwrite_x=True)
+                cube_new = spec.real.astype(rdtype)
+        del(spec)
+        if sink is not None:
+            with stage(instrument, "assemble", nbytes=cube_new.nbytes):
+                sink.open(cube_new.shape, cube_new.dtype, first)
+                for n in range(first,last+1):
+                    sink.write(n, cube_new[n-first])
+                sink.close()
+            cube_new = sink.result()
+        print("---")
+        print("Total elapsed time from begining = ", np.round(time.time()-t1,2))
+        print(" ")
+        return cube_new
     
     
     # Direct FFT
     
-    print(50*"=")
-    print("Calling bignfft")
-    print(50*"-")
-    
-    nfft_processor = BigNFFT(dimx, dimy, bxdim, bydim, path_tmp, batch_size=8)
-    nfft_processor.run(pm=-1, first=first, last=last)
-    #bignfft(-1, first,last,dimx,dimy,bxdim,bydim,path_tmp)
+    if resume in (None, "apo"):
+        print(50*"=")
+        print("Calling bignfft")
+        print(50*"-")
+        
+        with stage(instrument, "forward_fft", nbytes=spec.nbytes):
+            nfft_processor.run(pm=-1, first=first, last=last)
+            if apod is not None:
+                # BigNFFT leaves the temporal FFT unnormalized
+                apod.correct(spec, temporal_norm="backward", mean=av)
+                spec.flush()
+        #bignfft(-1, first,last,dimx,dimy,bxdim,bydim,path_tmp)
+        checkpoint("forward", spec)
+    else:
+        restore(resume, out=spec)
+    # size of the spectrum in the workspace, compressed or not
+    metric(instrument, "workspace", logical_bytes=spec.nbytes,
+           disk_bytes=nfft_processor.disk_bytes())
 
     
     # Multiplying transformed images by filter images
     
-    print('applying filter')
-    
-    
-    for n in tqdm(range(first,last+1)):
-        dcn = str(n).zfill(4)
-        ima = np.load(str0+"fft"+dcn+".npy")
-        filter = np.load(strf+dcn+".npy")
+    if resume != "filtered":
+        print('applying filter')
         
-        
-        ima = ima*filter
-        np.save(str0+"fft"+dcn+".npy",ima)
+        # with real=True only the non-negative temporal frequencies are stored
+        with stage(instrument, "filter", nbytes=spec.nbytes):
+            for k in tqdm(range(nfft_processor.nspec)):
+                filter = filter_slice(filter_mask, k, ydim, xdim, dtype=rdtype)
+                spec[k] *= filter
+            spec.flush()
+        del(filter)
+        checkpoint("filtered", spec)
 
-    del(ima)
-    del(filter)
+    del(spec)
+    del(filter_mask)
     
     #Inverse FFT
     print(50*"=")
@@ -222,43 +357,344 @@ def bigsonic(cube,first,last,bxdim,bydim,path_tmp):
     print(50*"-")
     
     #bignfft(1, first,last,dimx,dimy,bxdim,bydim,path_tmp)
-    nfft_processor.run(pm=1, first=first, last=last)
+    with stage(instrument, "inverse_fft", nbytes=nfft_processor.cube.nbytes):
+        nfft_processor.run(pm=1, first=first, last=last)
 
     
-    # Saving results
-    
-    ima = np.zeros([ydim,xdim],dtype="complex64")
+    # Saving results, frame by frame as they are read from the workspace
     
-    cube_new = np.zeros([tdim,ydim,xdim],dtype='float32')
+    sink = as_sink(sink)
+    sink.open((tdim,ydim,xdim), rdtype, first)
 
     
     
-    for n in range(first,last+1):
-        dcn = str(n).zfill(4)
-        ima = np.load(str0+"F"+dcn+".npy")
-        im = (ima.real)
-        cube_new[n,:,:] = im
+    with stage(instrument, "assemble", nbytes=tdim*frame_bytes):
+        for n in range(first,last+1):
+            sink.write(n, nfft_processor.read_frame(n-first))
+        sink.close()
+    cube_new = sink.result()
 
     
     print("---")
     print("Total elapsed time from begining = ", np.round(time.time()-t1,2))
     print(" ")
-    print("Erasing directories work and filter")
+    print("Erasing directory work")
     
+    nfft_processor.close()
     shutil.rmtree(str0)
-    shutil.rmtree(strf)
     return cube_new
 
 
-        
+def bigsonic_bank(cube,first,last,bxdim,bydim,path_tmp,specs,mode="auto",real=True,
+                  batch_size=8,workers=None,instrument=None,mask_cache=None,precision="single",
+                  roi=None,ap=0,store="memmap"):
+    """
+    Filter bank: cube[first:last+1] filtered with several subsonic masks.
 
+    specs is a list of dicts with any of v_ph, perct and cut (missing keys
+    take the bigsonic defaults). The forward spectrum is computed once and
+    every spec only costs one multiply and one inverse transform; in-core
+    the inverses of as many specs as fit in memory are batched in a single
+    multithreaded irfftn/ifftn call. Yields (spec, filtered cube) in the
+    order of specs. Same modes and options as bigsonic.
+    """
+    if mode not in ("auto", "incore", "disk"):
+        raise ValueError('The modes alowed are "auto", "incore" and "disk"')
+    rdtype, cdtype = precision_dtypes(precision)
+    cube = roi_view(cube, roi)
+    specs = [dict(spec) for spec in specs]
+    for spec in specs:
+        unknown = set(spec) - {"v_ph", "perct", "cut"}
+        if unknown:
+            raise ValueError(f"Unknown mask parameters {sorted(unknown)}")
+        spec.setdefault("v_ph", v_ph)
+        spec.setdefault("perct", 10)
+        spec.setdefault("cut", 1)
+    
+    xdim = cube.shape[2] - cube.shape[2]%2
+    ydim = cube.shape[1] - cube.shape[1]%2
+    if (last - first + 1)%2 != 0: last = last - 1
+    tdim = last - first + 1
+    frame_bytes = ydim*xdim*rdtype.itemsize
+    spec_bytes = (tdim//2+1 if real else tdim)*ydim*xdim*cdtype.itemsize
+    
+    if mode == "auto":
+        # plus the filtered copy of the spectrum of one spec
+        nbytes = incore_bytes(tdim, ydim, xdim, real, precision) + spec_bytes
+        mode = "incore" if fits_in_memory(nbytes) else "disk"
+    print("Mode ->", mode, "|", len(specs), "filters")
+    t1 = time.time()
     
+    apod = Apodization(tdim, ydim, xdim, ap=ap, dtype=rdtype) if ap != 0 else None
+    
+    def read(n):
+        ima = np.asarray(cube[n,:,:])[:ydim,:xdim]
+        return apod.apply(n-first, ima) if apod is not None else ima.astype(rdtype)
+    
+    def masks():
+        for spec in specs:
+            with stage(instrument, "mask"):
+                yield spec, subsonic_mask((ydim, xdim, tdim), scale, t_step, spec["v_ph"],
+                                          perct=spec["perct"], cut=spec["cut"],
+                                          cache_dir=mask_cache)
+    
+    if mode == "incore":
+        fft_workers = -1 if workers is None else workers
+        spec0 = np.empty([tdim,ydim,xdim],dtype=rdtype if real else cdtype)
+        with stage(instrument, "read_frames", nbytes=frame_bytes*tdim):
+            for n in tqdm(range(first,last+1)):
+                spec0[n-first] = read(n)
+        with stage(instrument, "forward_fft", nbytes=spec0.nbytes):
+            if real:
+                spec0 = rfftn(spec0, axes=(1,2,0), norm="ortho", workers=fft_workers)
+            else:
+                spec0 = fftn(spec0, axes=(0,1,2), norm="ortho", workers=fft_workers, overwrite_x=True)
+            if apod is not None:
+                apod.correct(spec0, temporal_norm="ortho")
         
-    
-        
-    
-    
-    
-    
-    
-    
+        # number of specs whose inverses run together: filtered spectra
+        # plus inverse temporaries plus real results
+        per_spec = spec0.nbytes*2 + tdim*ydim*xdim*rdtype.itemsize
+        nbatch = max(1, min(len(specs), int(0.8*available_memory())//per_spec))
+        pending = list(masks())
+        for b0 in range(0, len(pending), nbatch):
+            batch = pending[b0:b0+nbatch]
+            filtered = np.empty((len(batch),) + spec0.shape, dtype=spec0.dtype)
+            with stage(instrument, "filter", nbytes=filtered.nbytes):
+                for j, (spec, filter_mask) in enumerate(batch):
+                    for k in range(spec0.shape[0]):
+                        np.multiply(spec0[k], filter_slice(filter_mask, k, ydim, xdim, dtype=rdtype),
+                                    out=filtered[j, k])
+            with stage(instrument, "inverse_fft", nbytes=filtered.nbytes):
+                if real:
+                    cubes = irfftn(filtered, s=(ydim,xdim,tdim), axes=(2,3,1), norm="ortho",
+                                   workers=fft_workers, overwrite_x=True)
+                else:
+                    cubes = ifftn(filtered, axes=(1,2,3), norm="ortho", workers=fft_workers,
+                                  overwrite_x=True).real.astype(rdtype)
+            del(filtered)
+            for j, (spec, filter_mask) in enumerate(batch):
+                yield spec, cubes[j]
+            del(cubes)
+        print("Total elapsed time from begining = ", np.round(time.time()-t1,2))
+        return
+    
+    nfft_processor = BigNFFT(cube.shape[2], cube.shape[1], bxdim, bydim, path_tmp,
+                             batch_size=batch_size, real=real, workers=workers,
+                             instrument=instrument, precision=precision, store=store)
+    work = nfft_processor.allocate(tdim)
+    pristine = None
+    try:
+        with stage(instrument, "read_frames", nbytes=frame_bytes*tdim):
+            for n in tqdm(range(first,last+1)):
+                nfft_processor.write_frame(n-first, read(n))
+            nfft_processor.flush()
+        with stage(instrument, "forward_fft", nbytes=work.nbytes):
+            nfft_processor.run(pm=-1, first=first, last=last)
+            if apod is not None:
+                apod.correct(work, temporal_norm="backward")
+        # the forward spectrum is kept aside, every inverse overwrites the workspace
+        pristine = open_store(store, nfft_processor.str0 / "spectrum", work.shape, work.dtype,
+                              (batch_size, nfft_processor.bydim, nfft_processor.bxdim))
+        with stage(instrument, "copy_spectrum", nbytes=work.nbytes):
+            for k in range(nfft_processor.nspec):
+                pristine[k] = work[k]
+            pristine.flush()
+        for spec, filter_mask in masks():
+            print('applying filter', spec)
+            with stage(instrument, "filter", nbytes=work.nbytes):
+                for k in tqdm(range(nfft_processor.nspec)):
+                    work[k] = pristine[k]*filter_slice(filter_mask, k, ydim, xdim, dtype=rdtype)
+                work.flush()
+            with stage(instrument, "inverse_fft", nbytes=work.nbytes):
+                nfft_processor.run(pm=1, first=first, last=last)
+            cube_new = np.empty([tdim,ydim,xdim],dtype=rdtype)
+            with stage(instrument, "assemble", nbytes=cube_new.nbytes):
+                for n in range(tdim):
+                    cube_new[n] = nfft_processor.read_frame(n)
+            yield spec, cube_new
+            del(cube_new)
+    finally:
+        if pristine is not None:
+            if hasattr(pristine, "close"):
+                pristine.close()
+            del(pristine)
+        del(work)
+        nfft_processor.close()
+        shutil.rmtree(nfft_processor.str0, ignore_errors=True)
+    print("Total elapsed time from begining = ", np.round(time.time()-t1,2))
+
+
+def segment_starts(first, last, seg_len, overlap):
+    """
+    First frame of every temporal segment of seg_len frames covering
+    first..last, consecutive segments sharing at least overlap frames.
+    The fewest segments that allow it are spread evenly between first and
+    the last one, aligned to end at last (so a frame can be shared by more
+    than two segments; see blend_weights).
+    """
+    if seg_len % 2 != 0:
+        raise ValueError("seg_len must be even")
+    if not 0 <= overlap <= seg_len//2:
+        raise ValueError("overlap must be in [0, seg_len/2]")
+    if last - first + 1 <= seg_len:
+        return [first]
+    span = last - seg_len + 1 - first
+    n = -(-span // (seg_len - overlap)) + 1
+    return [first + (k*span)//(n-1) for k in range(n)]
+
+
+def edge_ramp(size, overlap, left=True, right=True):
+    """
+    Weights of a segment of size frames over the overlap frames next to
+    its left and/or right edge: 0 in the outer quarter, close to the edge,
+    and a raised-cosine ramp up to 1 in the central half; 1 elsewhere.
+    """
+    q = overlap//4
+    m = overlap - 2*q
+    ramp = np.concatenate([np.zeros(q), 0.5*(1-np.cos(np.pi*(np.arange(m)+0.5)/max(m, 1)))])
+    ramp = ramp[:size]
+    w = np.ones(size)
+    if left:
+        w[:len(ramp)] *= ramp
+    if right:
+        w[size-len(ramp):] *= ramp[::-1]
+    return w
+
+
+def bigsonic_segments(cube,first,last,bxdim,bydim,path_tmp,seg_len=256,overlap=64,**kwargs):
+    """
+    Segmented bigsonic for arbitrarily long time series.
+
+    cube[first:last+1] is filtered in overlapping temporal segments of
+    seg_len frames (each one through bigsonic, extra keyword arguments are
+    passed on). In the frames shared by several segments the results are
+    blended with weights summing to 1 (see blend_weights), which keeps
+    the edge artifacts of each segment's temporal FFT out of the output. Filtered frames
+    are yielded as (n, frame) in time order as soon as they are final, so
+    at most one segment plus one overlap is held in memory.
+    """
+    starts = segment_starts(first, last, seg_len, overlap)
+    weights = blend_weights([s - first for s in starts], seg_len, last - first + 1, overlap)
+    pending = None   # weighted sum of the previous segments from s0 on
+    for i, s0 in enumerate(starts):
+        out = bigsonic(cube, s0, min(s0+seg_len-1, last), bxdim, bydim, path_tmp, **kwargs)
+        s1 = s0 + len(out)   # bigsonic drops the last frame of odd ranges
+        acc = out * weights[i][:len(out), None, None].astype(out.dtype)
+        del out
+        if pending is not None:
+            acc[:len(pending)] += pending
+        # frames before the next segment are final
+        n1 = starts[i+1] if i+1 < len(starts) else s1
+        for n in range(s0, n1):
+            yield n, acc[n-s0]
+        pending = acc[n1-s0:]
+        del acc
+
+
+def blend_weights(starts, tile, size, overlap):
+    """
+    1D weights of every tile (or segment) starting at starts (length tile)
+    along an axis of size pixels: an edge_ramp over overlap pixels at each
+    edge inside the axis, normalized so that the weights of all the tiles
+    covering a pixel sum to 1.
+    """
+    weights = []
+    total = np.zeros(size)
+    for s0 in starts:
+        n = min(tile, size - s0)
+        w = edge_ramp(n, overlap, left=s0 > 0, right=s0 + n < size)
+        total[s0:s0+n] += w
+        weights.append(w)
+    return [w / total[s0:s0+len(w)] for s0, w in zip(starts, weights)]
+
+
+def _filter_tile(args):
+    source, first, last, bxdim, bydim, path_tmp, roi, kwargs = args
+    out = bigsonic(source, first, last, bxdim, bydim, path_tmp, roi=roi, **kwargs)
+    shutil.rmtree(path_tmp, ignore_errors=True)
+    return out
+
+
+def bigsonic_tiles(cube,first,last,bxdim,bydim,path_tmp,tile=512,overlap=64,processes=None,
+                   out=None,**kwargs):
+    """
+    Spatially tiled bigsonic for fields too large to filter at once
+    (e.g. full-disk 4096x4096 cubes).
+
+    The (even-cropped) field is split into tile x tile windows overlapping
+    by at least overlap pixels, each one filtered independently by bigsonic
+    (with its own Fourier grid and mask) in a pool of processes worker
+    processes, so the memory of every worker is bounded by the tile size.
+    With mode "auto" (default) the mode of all the tiles is chosen here,
+    "incore" only if processes in-core tiles fit together in the available
+    memory.
+    The tiles are blended with complementary raised-cosine spatial windows
+    in the overlaps (see blend_weights), which keeps the periodic-boundary
+    artifacts of each tile's FFT out of the seams. Extra keyword arguments
+    go to bigsonic; workers (FFT threads per process) defaults to 1, and
+    instrument, sink and cache (per-process objects) are not accepted.
+
+    cube can be an ndarray (it is dumped once to path_tmp/input.npy for
+    the workers), a FitsCube or an NpyCube. out, if given, is a preallocated
+    (last-first+1, ydim, xdim) array (e.g. an np.lib.format.open_memmap)
+    receiving the result; it is returned.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from cube_source import lazy_source
+
+    if tile % 2 != 0:
+        raise ValueError("tile must be even")
+    if not 0 <= overlap <= tile//2:
+        raise ValueError("overlap must be in [0, tile/2]")
+    for name in ("instrument", "sink", "cache"):
+        if kwargs.get(name) is not None:
+            raise ValueError(f"{name} cannot be passed to the tile workers of bigsonic_tiles")
+    kwargs.setdefault("workers", 1)
+    if (last - first + 1)%2 != 0: last = last - 1
+    tdim = last - first + 1
+    ydim = cube.shape[1] - cube.shape[1]%2
+    xdim = cube.shape[2] - cube.shape[2]%2
+    os.makedirs(path_tmp, exist_ok=True)
+    source, s_first, s_last = lazy_source(cube, os.path.join(path_tmp, "input"), first, last)
+
+    ystarts = segment_starts(0, ydim-1, tile, overlap)
+    xstarts = segment_starts(0, xdim-1, tile, overlap)
+    wy = blend_weights(ystarts, tile, ydim, overlap)
+    wx = blend_weights(xstarts, tile, xdim, overlap)
+    tasks = {}
+    for j, y0 in enumerate(ystarts):
+        for i, x0 in enumerate(xstarts):
+            roi = (y0, y0+len(wy[j]), x0, x0+len(wx[i]))
+            tile_tmp = os.path.join(path_tmp, f"tile_{j:03d}_{i:03d}/")
+            tasks[(j, i)] = (source, s_first, s_last, bxdim, bydim, tile_tmp, roi, kwargs)
+    print(len(tasks), "tiles of", tile, "x", tile, "pixels")
+
+    # Mode of every tile, with the available memory shared by the processes
+    if kwargs.get("mode", "auto") == "auto":
+        nproc = min(processes or os.cpu_count() or 1, len(tasks))
+        nbytes = incore_bytes(tdim, len(wy[0]), len(wx[0]), kwargs.get("real", True),
+                              kwargs.get("precision", "single"))
+        kwargs["mode"] = "incore" if fits_in_memory(nproc*nbytes) else "disk"
+        print("Tile mode ->", kwargs["mode"], "|", nproc, "processes")
+
+    if out is None:
+        out = np.zeros([tdim,ydim,xdim], dtype=precision_dtypes(kwargs.get("precision", "single"))[0])
+    else:
+        if out.shape != (tdim, ydim, xdim):
+            raise ValueError(f"out has shape {out.shape}, not {(tdim, ydim, xdim)}")
+        out[...] = 0
+    t1 = time.time()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(_filter_tile, task): key for key, task in tasks.items()}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            j, i = futures[future]
+            result = future.result()
+            y0, x0 = ystarts[j], xstarts[i]
+            w = (wy[j][:, None]*wx[i][None, :]).astype(out.dtype)
+            out[:, y0:y0+len(wy[j]), x0:x0+len(wx[i])] += result*w
+            del result
+    if source is not cube:
+        os.remove(source.path)   # frames dumped for the workers
+    print("Total elapsed time from begining = ", np.round(time.time()-t1,2))
+    return out
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+from pathlib import Path
+import numpy as np
+
+
+def make_key(*parts):
+    """
+    Content-addressed key: hex digest of the repr of parts.
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def input_key(cube, first, last):
+    """
+    Key of the frames first..last of cube.
+
+    Cubes with a fingerprint(first, last) method (e.g. FitsCube) are keyed
+    by it, without reading any pixel; other cubes (or a None fingerprint)
+    by the hash of their data.
+    """
+    fingerprint = getattr(cube, "fingerprint", None)
+    fingerprint = fingerprint(first, last) if fingerprint is not None else None
+    if fingerprint is not None:
+        return make_key("fingerprint", fingerprint)
+    h = hashlib.sha1()
+    h.update(repr((cube.shape, str(cube.dtype))).encode())
+    for n in range(first, last + 1):
+        h.update(np.ascontiguousarray(cube[n]).tobytes())
+    return h.hexdigest()
+
+
+class StageCache:
+    """
+    Directory of stage checkpoints (<stage>-<key>.npy) with a size cap.
+
+    Entries are written atomically, their modification time is refreshed
+    on every hit, and when the total size goes over max_bytes the least
+    recently used entries are evicted.
+    """
+    def __init__(self, root, max_bytes=50 * 2**30, chunk_bytes=2**28):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.chunk_bytes = chunk_bytes
+
+    def path(self, stage, key):
+        return self.root / f"{stage}-{key}.npy"
+
+    def has(self, stage, key):
+        return self.path(stage, key).exists()
+
+    def _chunk(self, array):
+        frame_bytes = max(1, array[0].nbytes) if len(array) else 1
+        return max(1, self.chunk_bytes // frame_bytes)
+
+    def load(self, stage, key, out=None):
+        """
+        Checkpoint stage/key, memory-mapped read-only, or copied into out
+        frame chunk by frame chunk. None if there is no such checkpoint.
+        """
+        path = self.path(stage, key)
+        try:
+            data = np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        if out is None:
+            return data
+        if data.shape != out.shape:
+            raise ValueError(f"Checkpoint {path.name} has shape {data.shape}, not {out.shape}")
+        step = self._chunk(data)
+        for t0 in range(0, len(data), step):
+            out[t0:t0 + step] = data[t0:t0 + step]
+        return out
+
+    def save(self, stage, key, array):
+        """
+        Store array as checkpoint stage/key and enforce the size cap.
+        """
+        path = self.path(stage, key)
+        tmp = path.with_name(path.name + ".tmp")
+        data = np.lib.format.open_memmap(tmp, mode="w+", dtype=array.dtype, shape=array.shape)
+        step = self._chunk(array)
+        for t0 in range(0, len(array), step):
+            data[t0:t0 + step] = array[t0:t0 + step]
+        data.flush()
+        del data
+        os.replace(tmp, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used checkpoints until the cache fits max_bytes.
+        """
+        entries = []
+        for path in self.root.glob("*.npy"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
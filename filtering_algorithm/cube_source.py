@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import glob
+import json
+import os
+import numpy as np
+from astropy.io import fits
+
+
+class FitsCube:
+    """
+    Lazy (T, H, W) cube over a sorted directory of FITS files.
+
+    Only the data HDU of each file is opened (memory-mapped when the file
+    is not compressed) and frames are decoded on demand, so indexing
+    cube[n] or cube[n, :, :] costs one frame, not the whole stack.
+    """
+    ndim = 3
+
+    def __init__(self, directory, pattern="*.fits", dtype=np.float32):
+        self.files = sorted(glob.glob(os.path.join(directory, pattern)))
+        if not self.files:
+            raise FileNotFoundError(f"No FITS files found in {directory}")
+        self.hdu_index = None
+        with fits.open(self.files[0], memmap=True) as hdul:
+            for i, hdu in enumerate(hdul):
+                if hdu.is_image and hdu.header.get("NAXIS", 0) >= 2:
+                    self.hdu_index = i
+                    header = hdu.header
+                    native = hdu.section[0:1, 0:1].dtype
+                    break
+        if self.hdu_index is None:
+            raise ValueError(f"No image HDU found in {self.files[0]}")
+        self.shape = (len(self.files), header["NAXIS2"], header["NAXIS1"])
+        self.dtype = np.dtype(dtype) if dtype is not None else native
+
+    def fingerprint(self, first=0, last=None):
+        """
+        Cheap identity of frames first..last: path, size and mtime of
+        each file plus the HDU and dtype read (no pixel is decoded).
+        """
+        last = len(self) - 1 if last is None else last
+        stats = []
+        for path in self.files[first:last + 1]:
+            st = os.stat(path)
+            stats.append((os.path.abspath(path), st.st_size, st.st_mtime_ns))
+        return (self.hdu_index, str(self.dtype), stats)
+
+    def header(self, n):
+        """
+        Header of the data HDU of frame n (WCS, DATE-OBS, ...).
+        """
+        with fits.open(self.files[n], memmap=True) as hdul:
+            return hdul[self.hdu_index].header.copy()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _frame(self, n, region):
+        with fits.open(self.files[n], memmap=True) as hdul:
+            data = hdul[self.hdu_index].section[region]
+            # copy before the file is closed
+            return np.array(data, dtype=self.dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        t, region = key[0], key[1:]
+        region = region + (slice(None),) * (2 - len(region))
+        if isinstance(t, (int, np.integer)):
+            return self._frame(int(t) % len(self), region)
+        frames = [self._frame(n, region) for n in range(*t.indices(len(self)))]
+        return np.stack(frames)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+
+def frames_table(path):
+    """
+    Per-frame table (DATE-OBS, T_OBS, EXPTIME, WCS keys, ...) written next
+    to a cube by the preprocessing (images_intensity/cube_store.py), or
+    None.
+    """
+    path = os.path.splitext(path)[0] + ".frames.json"
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)["frames"]
+
+
+class NpyCube:
+    """
+    (T, H, W) cube stored in a .npy file, memory-mapped read-only on first
+    access. Only the path is pickled, so it can be handed to worker
+    processes without copying the data. Frame headers come from the
+    frames table next to the file, when there is one.
+    """
+    ndim = 3
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._data = None
+        self._frames = None
+        self.shape = self.data.shape
+        self.dtype = self.data.dtype
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.load(self.path, mmap_mode="r")
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def fingerprint(self, first=0, last=None):
+        st = os.stat(self.path)
+        return (self.path, st.st_size, st.st_mtime_ns, first, last)
+
+    def header(self, n):
+        """
+        Header of frame n rebuilt from the frames table (empty without it).
+        """
+        if self._frames is None:
+            self._frames = frames_table(self.path) or []
+        header = fits.Header()
+        row = self._frames[n] if n < len(self._frames) else None
+        for key, value in (row or {}).items():
+            if key != "file" and value is not None:
+                header[key] = value
+        return header
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return np.array(self.data[key])
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+
+class CubeView:
+    """
+    (T, h, w) window cube[:, ys, xs] of another cube (ndarray, memmap or
+    FitsCube) that is never materialized: view[n] reads only that
+    hyperslab of frame n from the source.
+    """
+    ndim = 3
+
+    def __init__(self, cube, ys=slice(None), xs=slice(None)):
+        self.cube = cube
+        self.ranges = []
+        for sl, size in ((ys, cube.shape[1]), (xs, cube.shape[2])):
+            r = range(*sl.indices(size))
+            if r.step <= 0 or len(r) == 0:
+                raise ValueError(f"Empty or reversed ROI slice {sl} for an axis of {size} pixels")
+            self.ranges.append(r)
+        self.shape = (cube.shape[0], len(self.ranges[0]), len(self.ranges[1]))
+        self.dtype = cube.dtype
+
+    def fingerprint(self, first=0, last=None):
+        """
+        Fingerprint of the source (if it has one) plus the window, else None.
+        """
+        fingerprint = getattr(self.cube, "fingerprint", None)
+        if fingerprint is None:
+            return None
+        base = fingerprint(first, last)
+        if base is None:
+            return None
+        return (base, [(r.start, r.stop, r.step) for r in self.ranges])
+
+    def header(self, n):
+        """
+        Header of frame n of the source with the WCS reference pixel moved
+        to the window, or None if the source has no headers.
+        """
+        header = getattr(self.cube, "header", None)
+        if header is None:
+            return None
+        header = header(n)
+        (ry, rx) = self.ranges
+        for axis, r in (("1", rx), ("2", ry)):
+            if "CRPIX" + axis in header:
+                header["CRPIX" + axis] = (header["CRPIX" + axis] - 1 - r.start) / r.step + 1
+            if r.step != 1 and "CDELT" + axis in header:
+                header["CDELT" + axis] *= r.step
+        return header
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        t, region = key[0], key[1:]
+        region = region + (slice(None),) * (2 - len(region))
+        source = []
+        for r, k in zip(self.ranges, region):
+            sub = r[k]
+            if isinstance(sub, range):
+                sub = slice(sub.start, sub.stop if sub.stop >= 0 else None, sub.step)
+            source.append(sub)
+        return self.cube[(t,) + tuple(source)]
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+
+def roi_view(cube, roi):
+    """
+    cube itself if roi is None, else the CubeView of the pixel box
+    roi = (y0, y1, x0, x1) (half-open, like slices).
+    """
+    if roi is None:
+        return cube
+    y0, y1, x0, x1 = roi
+    if not (0 <= y0 < y1 <= cube.shape[1] and 0 <= x0 < x1 <= cube.shape[2]):
+        raise ValueError(f"ROI {roi} outside the {cube.shape[1]}x{cube.shape[2]} frames")
+    return CubeView(cube, slice(y0, y1), slice(x0, x1))
+
+
+def open_cube(path, dtype=np.float32):
+    """
+    Cube for path: a FitsCube for a directory of FITS files, an NpyCube
+    for a .npy cube and the zarr array for a .zarr cube (these two as
+    written by the preprocessing, see frames_table).
+    """
+    if os.path.isdir(path) and not path.rstrip("/").endswith(".zarr"):
+        return FitsCube(path, dtype=dtype)
+    if path.endswith(".npy"):
+        return NpyCube(path)
+    import zarr
+    return zarr.open_array(path, mode="r")
+
+
+def lazy_source(cube, path, first=0, last=None):
+    """
+    (source, first, last) where source can be pickled to worker processes
+    without its data: FitsCube and NpyCube (or views of them) are returned
+    as they are, any other cube has frames first..last dumped to path.npy.
+    """
+    base = cube.cube if isinstance(cube, CubeView) else cube
+    last = len(cube) - 1 if last is None else last
+    if isinstance(base, (FitsCube, NpyCube)):
+        return cube, first, last
+    path = str(path) + ".npy"
+    data = np.lib.format.open_memmap(path, mode="w+", dtype=cube.dtype,
+                                     shape=(last - first + 1,) + tuple(cube.shape[1:]))
+    for n in range(first, last + 1):
+        data[n - first] = cube[n]
+    data.flush()
+    del data
+    return NpyCube(path), 0, last - first
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import numpy as np
+import dask
+import dask.array as da
+from scipy.fft import fft, ifft, rfft2, irfft2
+
+from bignfft_new import precision_dtypes
+from cube_source import roi_view
+from apodization import Apodization
+from subsonic_mask import subsonic_mask, filter_region
+
+
+def _spatial_forward(block, norm):
+    return rfft2(block, axes=(-2, -1), norm=norm, workers=1)
+
+
+def _spatial_inverse(block, xdim, norm):
+    return irfft2(block, s=(block.shape[1], xdim), axes=(-2, -1), norm=norm, workers=1)
+
+
+def _temporal(block, pm):
+    if pm == -1:
+        return fft(block, axis=0, norm="ortho", overwrite_x=True, workers=1)
+    return ifft(block, axis=0, norm="ortho", overwrite_x=True, workers=1)
+
+
+def _apply_mask(block, filter_mask, ydim, xdim, block_info=None):
+    (k0, k1), (y0, y1), (x0, x1) = block_info[0]["array-location"]
+    block = block.copy()
+    block *= filter_region(filter_mask, range(k0, k1), range(y0, y1), range(x0, x1),
+                           ydim, xdim, dtype=block.real.dtype)
+    return block
+
+
+def bigsonic_dask(cube,first,last,bxdim,bydim,path_tmp,frame_chunk=8,precision="single",
+                  mask_cache=None,roi=None,store=None,compute=True,ap=0):
+    """
+    bigsonic on chunked dask arrays (local threads, a LocalCluster or a
+    multi-node dask.distributed cluster: whatever client is active).
+
+    The input is read in chunks of frame_chunk frames, each chunk gets its
+    spatial real FFT (rfft2: the subsonic mask is mirror-symmetric in kx,
+    so only the non-negative kx half is kept), the spectrum is rechunked
+    to time-major (T, bydim, bxdim) blocks for the temporal FFT, the mask
+    is applied blockwise (filter_region) and the inverse path runs in the
+    opposite order. Same normalization as the in-core bigsonic. ap as in
+    bigsonic (here the cube mean is one more dask reduction over the input).
+
+    The result is written to the zarr store (default path_tmp/filtered.zarr)
+    and returned as a dask array reading it. With compute=False nothing is
+    run: the returned array is the lazy graph, for the caller to store.
+    """
+    from bigsonic_hmi import scale, t_step, v_ph
+
+    rdtype, cdtype = precision_dtypes(precision)
+    cube = roi_view(cube, roi)
+    if (last - first + 1)%2 != 0: last = last - 1
+    tdim = last - first + 1
+    ydim = cube.shape[1] - cube.shape[1]%2
+    xdim = cube.shape[2] - cube.shape[2]%2
+    print(tdim, " images to be filtered (dask)")
+
+    filter_mask = subsonic_mask((ydim, xdim, tdim), scale, t_step, v_ph, cache_dir=mask_cache)
+    # shipped once to the workers instead of being embedded in every task
+    filter_mask = dask.delayed(np.asarray(filter_mask), pure=True)
+
+    if isinstance(cube, da.Array):
+        frames = cube[first:last+1, :ydim, :xdim]
+    else:
+        frames = da.from_array(cube, chunks=(frame_chunk, -1, -1), asarray=True,
+                               lock=False)[first:last+1, :ydim, :xdim]
+    frames = frames.rechunk((frame_chunk, -1, -1)).astype(rdtype)
+    if ap != 0:
+        apod = Apodization(tdim, ydim, xdim, ap=ap, dtype=rdtype)
+        av = frames.mean(dtype=np.float64).astype(rdtype)
+        windowed = (frames - av)*apod.wt[:, None, None].astype(rdtype)
+        if apod.wxy is not None:
+            windowed = windowed*apod.wxy.astype(rdtype)
+        frames = (windowed + av).astype(rdtype)
+
+    # forward: spatial rfft2 per frame chunk, temporal FFT per time-major block
+    spec = frames.map_blocks(_spatial_forward, "ortho", dtype=cdtype,
+                             chunks=(frames.chunks[0], (ydim,), (xdim//2+1,)))
+    spec = spec.rechunk((-1, bydim, bxdim))
+    spec = spec.map_blocks(_temporal, -1, dtype=cdtype)
+
+    # filter and inverse
+    spec = spec.map_blocks(_apply_mask, filter_mask, ydim, xdim, dtype=cdtype)
+    spec = spec.map_blocks(_temporal, 1, dtype=cdtype)
+    spec = spec.rechunk((frame_chunk, -1, -1))
+    cube_new = spec.map_blocks(_spatial_inverse, xdim, "ortho", dtype=rdtype,
+                               chunks=(spec.chunks[0], (ydim,), (xdim,)))
+    if not compute:
+        return cube_new
+
+    store = os.path.join(path_tmp, "filtered.zarr") if store is None else store
+    t1 = time.time()
+    cube_new.to_zarr(store, overwrite=True)
+    print("Total elapsed time from begining = ", np.round(time.time()-t1,2))
+    return da.from_zarr(store)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import cProfile
+import json
+import resource
+import time
+import tracemalloc
+
+
+# Shared no-op context: a disabled instrument costs one None check per stage
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def io_counters():
+    """
+    Bytes read from / written to storage by this process (Linux only).
+    """
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["read_bytes"]), int(io["write_bytes"])
+    except (OSError, KeyError):
+        return 0, 0
+
+
+def reset_peak_rss():
+    """
+    Reset the kernel's peak RSS counter (Linux only, no-op elsewhere).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+    Peak resident set size in bytes since the last reset_peak_rss.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def stage(instrument, name, nbytes=0):
+    """
+    Context manager timing the stage name on instrument (None: disabled).
+    """
+    if instrument is None:
+        return _NULL_STAGE
+    return instrument.stage(name, nbytes)
+
+
+def metric(instrument, name, **values):
+    """
+    Emit the measurement name (values) on instrument (None: disabled).
+    """
+    if instrument is not None:
+        instrument.metric(name, **values)
+
+
+class Instrument:
+    """
+    Emitter of pipeline stage events.
+
+    Every callback receives one dict per event: {"event": "start", ...}
+    when a stage begins and {"event": "end", ...} with duration_s, bytes
+    (data processed by the stage), peak_rss_bytes and storage read_bytes /
+    write_bytes when it ends. Nested stages are named "outer/inner".
+    metric emits {"event": "metric", ...} with values measured inside a
+    stage (e.g. the size of a workspace on disk).
+
+    profile=True runs cProfile over every stage (stats are dumped to
+    profile_path, or kept in self.profiler), trace_memory=True adds the
+    Python-level tracemalloc peak (py_peak_bytes) to the end events.
+    """
+    def __init__(self, callbacks=(), profile=False, profile_path=None, trace_memory=False):
+        self.callbacks = list(callbacks)
+        self.profiler = cProfile.Profile() if profile else None
+        self.profile_path = profile_path
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._stack = []
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def emit(self, event):
+        for callback in self.callbacks:
+            callback(event)
+
+    @contextlib.contextmanager
+    def stage(self, name, nbytes=0):
+        path = "/".join([s["stage"] for s in self._stack] + [name])
+        hwm = peak_rss()
+        py_hwm = tracemalloc.get_traced_memory()[1] if self.trace_memory else 0
+        for parent in self._stack:
+            parent["peak"] = max(parent["peak"], hwm)
+            parent["py_peak"] = max(parent["py_peak"], py_hwm)
+        reset_peak_rss()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        if self.profiler is not None and not self._stack:
+            self.profiler.enable()
+        current = {"stage": name, "peak": 0, "py_peak": 0}
+        self._stack.append(current)
+        r0, w0 = io_counters()
+        t0 = time.perf_counter()
+        self.emit({"event": "start", "stage": path, "time": time.time()})
+        try:
+            yield current
+        finally:
+            duration = time.perf_counter() - t0
+            r1, w1 = io_counters()
+            self._stack.pop()
+            if self.profiler is not None and not self._stack:
+                self.profiler.disable()
+            peak = max(current["peak"], peak_rss())
+            py_peak = 0
+            if self.trace_memory:
+                py_peak = max(current["py_peak"], tracemalloc.get_traced_memory()[1])
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+                self._stack[-1]["py_peak"] = max(self._stack[-1]["py_peak"], py_peak)
+            event = {"event": "end", "stage": path, "time": time.time(),
+                     "duration_s": duration, "bytes": int(nbytes),
+                     "peak_rss_bytes": peak,
+                     "read_bytes": r1 - r0, "write_bytes": w1 - w0}
+            if self.trace_memory:
+                event["py_peak_bytes"] = py_peak
+            self.emit(event)
+
+    def metric(self, name, **values):
+        path = "/".join([s["stage"] for s in self._stack] + [name])
+        event = {"event": "metric", "stage": path, "time": time.time()}
+        event.update(values)
+        self.emit(event)
+
+    def close(self):
+        """
+        Dump the profile (if any) and stop tracing memory.
+        """
+        if self.profiler is not None and self.profile_path is not None:
+            self.profiler.dump_stats(self.profile_path)
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+class JsonLinesSink:
+    """
+    Instrument callback appending every event as one JSON line to path.
+    """
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def __call__(self, event):
+        self.file.write(json.dumps(event) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -3,42 +3,53 @@
 #!/usr/bin/env python3
 # apply_bigsonic.py
 
-import os
-import glob
 import numpy as np
-from sunpy.map import Map
+from cube_source import FitsCube, open_cube, roi_view
+from output_sink import NpySink, FitsSink
 from bignfft_new import BigNFFT
 from bigsonic_hmi import bigsonic  # Renombra tu script original a bignfft_script.py
                                      # y asegúrate de que defina la función bigsonic
 
 # -------- CONFIGURACIÓN --------
 INPUT_DIR = "./../images_intensity/data_hmi_Ic_45s_crop_dr/"
+INPUT_CUBE = None   # p. ej. "./../images_intensity/data_hmi_Ic_45s_crop_dr.npy": cubo del preprocesado (OUTPUT_CUBE), se abre sin leer los FITS
 OUTPUT_PATH = "bigsonic_output/"
 BXDIM = 1001.5274800000001 #216
 BYDIM = 1001.5274800000001 #216
+ROI = None          # (y0, y1, x0, x1) en píxeles para filtrar solo esa región; None = frame completo
+FIRST, LAST = 0, None   # rango de frames (LAST = None: hasta el final)
+OUTPUT_NPY = "filtered_cube.npy"
+OUTPUT_FITS_DIR = None  # p. ej. "filtered_fits/": un FITS por frame con la cabecera original
 
 # -------- LEER IMÁGENES Y CREAR CUBO --------
-fits_files = sorted(glob.glob(os.path.join(INPUT_DIR, "*.fits")))
-if not fits_files:
-    raise FileNotFoundError(f"No FITS files found in {INPUT_DIR}")
-
-for f in fits_files:
-    print(len(Map(f).data))
-# Cargar los mapas como un cubo de datos: (tiempo, altura, ancho)
-cube_data = np.stack([Map(f).data for f in fits_files])
-first_index = 0
-last_index = cube_data.shape[0] - 1
+# Cubo perezoso (tiempo, altura, ancho): cada frame se lee del FITS al pedirlo,
+# o del cubo del preprocesado (memmap/zarr) si se da INPUT_CUBE
+if INPUT_CUBE is None:
+    cube_data = FitsCube(INPUT_DIR, dtype=np.float32)
+else:
+    cube_data = open_cube(INPUT_CUBE)
+print("Forma del cubo:", cube_data.shape)
+first_index = FIRST
+last_index = cube_data.shape[0] - 1 if LAST is None else LAST
 
 # -------- APLICAR FILTRO --------
+# Los frames filtrados se escriben a disco según salen de la FFT inversa
+if OUTPUT_FITS_DIR is None:
+    sink = NpySink(OUTPUT_NPY)
+else:
+    sink = FitsSink(OUTPUT_FITS_DIR, source=roi_view(cube_data, ROI))
 filtered_cube = bigsonic(
     cube=cube_data,
     first=first_index,
     last=last_index,
     bxdim=BXDIM,
     bydim=BYDIM,
-    path_tmp=OUTPUT_PATH
+    path_tmp=OUTPUT_PATH,
+    roi=ROI,
+    sink=sink
 )
 
-# -------- GUARDAR CUBO FILTRADO --------
-np.save("filtered_cube.npy", filtered_cube)
-print("Cubo filtrado guardado como 'filtered_cube.npy'")
+if OUTPUT_FITS_DIR is None:
+    print(f"Cubo filtrado guardado como '{OUTPUT_NPY}'")
+else:
+    print(f"{len(filtered_cube)} frames filtrados guardados en '{OUTPUT_FITS_DIR}'")
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+
+
+class ArraySink:
+    """
+    Output sink keeping the filtered cube in memory (the default of bigsonic).
+
+    Every sink is used as: open(shape, dtype, first), write(n, frame) for
+    each frame n (index in the source cube, first..first+shape[0]-1) as
+    soon as it is filtered, close(), and result() is what bigsonic returns.
+    """
+    def open(self, shape, dtype, first):
+        self.first = first
+        self.cube = np.empty(shape, dtype=dtype)
+
+    def write(self, n, frame):
+        self.cube[n - self.first] = frame
+
+    def close(self):
+        pass
+
+    def result(self):
+        return self.cube
+
+
+class NpySink(ArraySink):
+    """
+    Filtered cube written frame by frame into a .npy file (memory-mapped),
+    readable with np.load(path, mmap_mode="r") like filtered_cube.npy.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, shape, dtype, first):
+        self.first = first
+        self.cube = np.lib.format.open_memmap(self.path, mode="w+", dtype=dtype, shape=shape)
+
+    def close(self):
+        self.cube.flush()
+
+
+def _source_header(source, n):
+    header = getattr(source, "header", None)
+    return header(n) if header is not None else None
+
+
+def _source_file(source, n):
+    base = getattr(source, "cube", source)   # CubeView -> its source
+    files = getattr(base, "files", None)
+    return os.path.basename(files[n]) if files is not None else None
+
+
+class FitsSink:
+    """
+    One FITS file per filtered frame in directory, named after the source
+    file (prefix + name) when the source is a FitsCube, else
+    prefix + frame number. The header of the source frame is copied (WCS,
+    DATE-OBS, ...; see FitsCube.header / CubeView.header) with the
+    scaling, checksum and compression keywords dropped and a HISTORY card.
+    """
+    _DROP = ("BZERO", "BSCALE", "BLANK", "CHECKSUM", "DATASUM", "XTENSION", "PCOUNT",
+             "GCOUNT", "EXTNAME")
+
+    def __init__(self, directory, source=None, prefix="filtered_", history=None):
+        self.directory = directory
+        self.source = source
+        self.prefix = prefix
+        self.history = history or "p-modes removed with the bigsonic subsonic filter"
+        self.paths = []
+
+    def open(self, shape, dtype, first):
+        os.makedirs(self.directory, exist_ok=True)
+        self.paths = []
+
+    def write(self, n, frame):
+        from astropy.io import fits
+        header = _source_header(self.source, n) if self.source is not None else None
+        header = fits.Header() if header is None else header.copy()
+        for key in self._DROP:
+            header.remove(key, ignore_missing=True, remove_all=True)
+        header.add_history(self.history)
+        name = _source_file(self.source, n) if self.source is not None else None
+        name = self.prefix + (name or f"{n:06d}.fits")
+        path = os.path.join(self.directory, name)
+        fits.PrimaryHDU(data=np.asarray(frame), header=header).writeto(path, overwrite=True)
+        self.paths.append(path)
+
+    def close(self):
+        pass
+
+    def result(self):
+        return self.paths
+
+
+class ZarrSink:
+    """
+    Filtered cube as a zarr group at path: "filtered" (T, H, W) in chunks
+    of chunk_frames frames, "index" (T,) with the source frame number of
+    every frame, and attrs "date_obs" (DATE-OBS of every frame, when the
+    source has headers) and "written" (frames already complete, updated
+    chunk by chunk so the cube can be consumed while it is being written).
+    """
+    def __init__(self, path, chunk_frames=8, source=None):
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.source = source
+
+    @staticmethod
+    def _create(group, name, shape, chunks, dtype):
+        create = getattr(group, "create_array", None) or group.create_dataset
+        return create(name, shape=shape, chunks=chunks, dtype=dtype)
+
+    def open(self, shape, dtype, first):
+        import zarr
+        self.first = first
+        self.group = zarr.open_group(self.path, mode="w")
+        self.cube = self._create(self.group, "filtered", shape,
+                                 (min(self.chunk_frames, shape[0]),) + tuple(shape[1:]), dtype)
+        index = self._create(self.group, "index", (shape[0],), (shape[0],), "int64")
+        index[:] = np.arange(first, first + shape[0])
+        if self.source is not None and getattr(self.source, "header", None) is not None:
+            self.group.attrs["date_obs"] = [str(self.source.header(n).get("DATE-OBS", ""))
+                                            for n in range(first, first + shape[0])]
+        self.group.attrs["written"] = 0
+        self._buffer = np.empty((self.cube.chunks[0],) + tuple(shape[1:]), dtype=dtype)
+        self._start = None   # first frame (0-based) of the buffered chunk
+        self._count = 0
+
+    def _flush(self):
+        if self._start is None:
+            return
+        self.cube[self._start:self._start + self._count] = self._buffer[:self._count]
+        self.group.attrs["written"] = self._start + self._count
+        self._start = None
+        self._count = 0
+
+    def write(self, n, frame):
+        t = n - self.first
+        t0 = t - t % len(self._buffer)
+        if self._start != t0:
+            self._flush()
+            self._start = t0
+        self._buffer[t - t0] = frame
+        self._count = max(self._count, t - t0 + 1)
+        if self._count == len(self._buffer):
+            self._flush()
+
+    def close(self):
+        self._flush()
+
+    def result(self):
+        return self.cube
+
+
+def as_sink(sink):
+    """
+    ArraySink() for None, a sink as is.
+    """
+    return ArraySink() if sink is None else sink
+
+
+def write_stream(frames, sink, shape, dtype, first):
+    """
+    Feed a stream of (n, frame) (e.g. bigsonic_segments) into sink and
+    return its result.
+    """
+    sink.open(shape, dtype, first)
+    try:
+        for n, frame in frames:
+            sink.write(n, frame)
+    finally:
+        sink.close()
+    return sink.result()
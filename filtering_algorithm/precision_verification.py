@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# precision_verification.py
+
+import time
+import numpy as np
+from benchmark import relative_rms, synthetic_cube
+from bigsonic_hmi import bigsonic
+
+# -------- CONFIGURACIÓN --------
+T, H, W  = 128, 96, 96
+BXDIM    = 32
+BYDIM    = 32
+TOL      = 1e-4   # rms máximo de la diferencia single/double, en unidades de la desviación estándar
+PATH_TMP = "bigsonic_output/"
+
+# -------- 1) Cubo sintético (el de benchmark.py) --------
+cube = synthetic_cube(T, H, W)
+
+# -------- 2) Precisión simple frente a doble, en memoria y en disco --------
+failed = False
+for mode in ("incore", "disk"):
+    for real in (True, False):
+        t0 = time.time()
+        single = bigsonic(cube, 0, T-1, BXDIM, BYDIM, PATH_TMP, mode=mode, real=real,
+                          precision="single")
+        t_single = time.time() - t0
+        t0 = time.time()
+        double = bigsonic(cube, 0, T-1, BXDIM, BYDIM, PATH_TMP, mode=mode, real=real,
+                          precision="double")
+        t_double = time.time() - t0
+        diff = single.astype(np.float64) - double
+        rms = relative_rms(single, double)
+        print(f"{mode:6s} real={real!s:5s}: {single.dtype} vs {double.dtype}, "
+              f"rms/std = {rms:.2e}, max|diff| = {np.abs(diff).max():.2e}, "
+              f"tiempo {t_single:.2f} s vs {t_double:.2f} s")
+        failed |= rms > TOL
+
+# -------- 3) Resultado --------
+if failed:
+    raise SystemExit(f"La precisión simple supera la tolerancia {TOL}")
+print("Precisión simple verificada (tolerancia", TOL, ")")
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# segment_verification.py
+
+import numpy as np
+from benchmark import relative_rms, synthetic_cube
+from bigsonic_hmi import bigsonic, bigsonic_segments, segment_starts
+
+# -------- CONFIGURACIÓN --------
+T, H, W  = 600, 64, 64
+SEG_LEN  = 256
+OVERLAP  = 128
+BXDIM    = 32
+BYDIM    = 32
+TOL      = 0.1    # rms máximo de la diferencia, en unidades de la desviación estándar
+PATH_TMP = "bigsonic_output/"
+
+# -------- 1) Cubo sintético (el de benchmark.py) --------
+cube = synthetic_cube(T, H, W)
+
+# -------- 2) Filtrado monolítico y por segmentos --------
+mono = bigsonic(cube, 0, T-1, BXDIM, BYDIM, PATH_TMP)
+seg = np.empty_like(mono)
+for n, frame in bigsonic_segments(cube, 0, T-1, BXDIM, BYDIM, PATH_TMP,
+                                  seg_len=SEG_LEN, overlap=OVERLAP):
+    seg[n] = frame
+
+# -------- 3) Comparación en cada solape entre segmentos --------
+starts = segment_starts(0, T-1, SEG_LEN, OVERLAP)
+worst = (0., None)
+for s0, s1 in zip(starts[:-1], starts[1:]):
+    rms = relative_rms(seg[s1:s0+SEG_LEN], mono[s1:s0+SEG_LEN])
+    print(f"solape {s1}-{s0+SEG_LEN-1} ({s0+SEG_LEN-s1} frames): "
+          f"rms(segmentado - monolítico) / std = {rms:.3f}")
+    worst = max(worst, (rms, s1))
+print(f"peor solape (desde el frame {worst[1]}): rms / std = {worst[0]:.3f} (tolerancia {TOL})")
+if worst[0] > TOL:
+    raise SystemExit("El modo segmentado no reproduce el resultado monolítico")
+print("Modo segmentado verificado")
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import numpy as np
+
+
+# In-memory cache of already computed masks, keyed by mask_key(...)
+_MASK_CACHE = {}
+
+
+def mask_key(shape, scale, t_step, v_ph, perct, cut=1):
+    """
+    Hashable key identifying a subsonic mask.
+    """
+    ydim, xdim, tdim = (int(s) for s in shape)
+    return (ydim, xdim, tdim, float(scale), float(t_step), float(v_ph),
+            float(perct), int(cut))
+
+
+def _taper_profile(nt, perct):
+    """
+    Cosine taper along the temporal frequency axis.
+
+    Returns, for every temporal frequency index p, the index of the last
+    taper window that writes p (0 when none does) and the value it writes.
+    Windows are written in increasing order of k, so the last one wins.
+    """
+    owner = np.zeros(nt, dtype=int)
+    value = np.zeros(nt, dtype=float)
+    for k in range(1, nt):
+        trans = perct*k/100
+        trans2 = int(trans/2)
+        trans = 2*trans
+        if trans2 < 1:
+            continue
+        kk = np.arange(int(k-trans2), min(int(k+trans2), nt))
+        if kk.size == 0:
+            continue
+        n = np.arange(kk.size)
+        owner[kk] = k
+        value[kk] = 0.5+0.5*np.cos(np.pi*n/trans)
+    return owner, value
+
+
+def compute_subsonic_mask(shape, scale, t_step, v_ph, perct=10, cut=1):
+    """
+    Subsonic filter on the non-negative (ny, nx, nt) quadrant of the
+    Fourier domain for a cube of shape (ydim, xdim, tdim).
+
+    cut = 0: sharp phase-velocity cone.
+    cut = 1: cone with a cosine taper of width perct % of the frequency.
+    cut = 2: empty mask.
+    """
+    if (cut > 2) or (cut < 0):
+        raise ValueError('The cut values alowed are 0, 1, and 2')
+
+    ydim, xdim, tdim = (int(s) for s in shape)
+    kx_step = 1./(scale*725.*xdim)
+    ky_step = 1./(scale*725.*ydim)
+    w_step = 1./(t_step*tdim)
+
+    nx = int(xdim/2) + 1
+    ny = int(ydim/2) + 1
+    nt = int(tdim/2) + 1
+    filter_mask = np.zeros([ny, nx, nt], dtype=float)
+    if cut == 2:
+        return filter_mask
+
+    ky = (np.arange(ny)*ky_step)[:, None]
+    kx = (np.arange(nx)*kx_step)[None, :]
+    k_by_v = np.sqrt(kx**2+ky**2)*v_ph
+    k = np.arange(nt)
+    cone = (k[None, None, :]*w_step <= k_by_v[:, :, None]) & (k >= 1)
+    filter_mask[cone] = 1.
+    if cut == 0:
+        return filter_mask
+
+    # The cone is contiguous in k, so the taper starts right after its
+    # last frequency. A window started at k only affects the columns whose
+    # taper starts at or before k.
+    owner, value = _taper_profile(nt, perct)
+    k_start = np.maximum(cone.sum(axis=2) + 1, 1)
+    tapered = (owner[None, None, :] >= k_start[:, :, None]) & (owner > 0)
+    filter_mask = np.where(tapered, value[None, None, :], filter_mask)
+    return filter_mask
+
+
+def subsonic_mask(shape, scale, t_step, v_ph, perct=10, cut=1, cache_dir=None):
+    """
+    Memoized subsonic mask (see compute_subsonic_mask).
+
+    Masks are kept in memory for the life of the process and, when
+    cache_dir is given, stored there as .npy so later runs over cubes of
+    the same shape do not recompute them. The returned array is read-only.
+    """
+    key = mask_key(shape, scale, t_step, v_ph, perct, cut)
+    filter_mask = _MASK_CACHE.get(key)
+    if filter_mask is not None:
+        return filter_mask
+
+    path = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        path = os.path.join(cache_dir, f"subsonic_{digest}.npy")
+        if os.path.exists(path):
+            filter_mask = np.load(path)
+
+    if filter_mask is None:
+        filter_mask = compute_subsonic_mask(key[:3], scale, t_step, v_ph,
+                                            perct=perct, cut=cut)
+        if path is not None:
+            np.save(path, filter_mask)
+
+    filter_mask.setflags(write=False)
+    _MASK_CACHE[key] = filter_mask
+    return filter_mask
+
+
+def clear_mask_cache():
+    """
+    Drop every mask held in memory (disk caches are left untouched).
+    """
+    _MASK_CACHE.clear()
+
+
+def filter_slice(filter_mask, k, ydim, xdim, dtype=float):
+    """
+    Full (ydim, xdim) filter for the k-th temporal frequency of the FFT,
+    rebuilt from the compact quadrant mask by mirror symmetry.
+    """
+    ny, nx, nt = filter_mask.shape
+    tdim = 2*(nt-1)
+    i = k if k < nt else tdim-k
+    if i == 0:
+        return np.ones([ydim, xdim], dtype=dtype)
+    filter_slice = np.empty([ydim, xdim], dtype=dtype)
+    filter_slice[0:ny, 0:nx] = filter_mask[:, :, i]
+    filter_slice[ny:ydim, 0:nx] = filter_slice[1:ny-1, 0:nx][::-1, :]
+    filter_slice[:, nx:xdim] = filter_slice[:, 1:nx-1][:, ::-1]
+    return filter_slice
+
+
+def filter_region(filter_mask, ks, ys, xs, ydim, xdim, dtype=float):
+    """
+    Block [ks, ys, xs] (ranges of temporal frequency, row and column
+    indices) of the full filter, i.e. the stack of filter_slice(k) for k
+    in ks cropped to ys, xs, built without the full slices.
+    """
+    ny, nx, nt = filter_mask.shape
+    tdim = 2*(nt-1)
+    ks, ys, xs = np.asarray(ks), np.asarray(ys), np.asarray(xs)
+    ti = np.where(ks < nt, ks, tdim - ks)
+    yi = np.where(ys < ny, ys, ydim - ys)
+    xi = np.where(xs < nx, xs, xdim - xs)
+    block = np.moveaxis(filter_mask[np.ix_(yi, xi, ti)], 2, 0).astype(dtype)
+    block[ti == 0] = 1
+    return block
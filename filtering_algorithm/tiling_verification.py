@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# tiling_verification.py
+
+import time
+from benchmark import relative_rms, synthetic_cube
+from bigsonic_hmi import bigsonic, bigsonic_tiles
+
+# -------- CONFIGURACIÓN --------
+T, H, W   = 128, 256, 256
+TILE      = 128
+OVERLAP   = 64
+PROCESSES = 4
+BXDIM     = 32
+BYDIM     = 32
+TOL       = 0.1    # rms máximo de la diferencia, en unidades de la desviación estándar
+PATH_TMP  = "bigsonic_output/"
+
+if __name__ == "__main__":
+    # -------- 1) Cubo sintético (el de benchmark.py) --------
+    cube = synthetic_cube(T, H, W)
+
+    # -------- 2) Filtrado monolítico y por teselas --------
+    t0 = time.time()
+    mono = bigsonic(cube, 0, T-1, BXDIM, BYDIM, PATH_TMP)
+    t_mono = time.time() - t0
+    t0 = time.time()
+    tiled = bigsonic_tiles(cube, 0, T-1, BXDIM, BYDIM, PATH_TMP, tile=TILE,
+                           overlap=OVERLAP, processes=PROCESSES)
+    t_tiled = time.time() - t0
+
+    # -------- 3) Comparación lejos de los bordes del campo --------
+    edge = OVERLAP//2
+    inner = (slice(None), slice(edge, H-edge), slice(edge, W-edge))
+    rms = relative_rms(tiled[inner], mono[inner])
+    print(f"rms(teselado - monolítico) / std = {rms:.3f} (tolerancia {TOL})")
+    print(f"tiempo: monolítico {t_mono:.2f} s, teselado {t_tiled:.2f} s ({PROCESSES} procesos)")
+    if rms > TOL:
+        raise SystemExit("El modo teselado no reproduce el resultado monolítico")
+    print("Modo teselado verificado")
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+
+STORES = ("memmap", "zarr", "hdf5")
+
+
+class ChunkedArray:
+    """
+    numpy-like (shape, dtype, nbytes, slicing, flush) front of a chunked
+    compressed dataset (zarr array or h5py dataset). Slices are read and
+    written as plain ndarrays, so code written for the memmap workspace
+    works unchanged as long as it assigns back what it modifies.
+    """
+    def __init__(self, data, path, h5file=None):
+        self.data = data
+        self.path = path
+        self.h5file = h5file
+        self.shape = tuple(data.shape)
+        self.dtype = np.dtype(data.dtype)
+        self.itemsize = self.dtype.itemsize
+        self.nbytes = int(np.prod(self.shape)) * self.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return np.asarray(self.data[key])
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def flush(self):
+        if self.h5file is not None:
+            self.h5file.flush()
+
+    def close(self):
+        if self.h5file is not None:
+            self.h5file.close()
+            self.h5file = None
+
+
+def _zarr_array(path, shape, dtype, chunks, clevel, shuffle):
+    import zarr
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        from zarr.codecs import BloscCodec
+        codec = BloscCodec(cname="zstd", clevel=clevel, shuffle="shuffle" if shuffle else "noshuffle")
+        return zarr.create_array(str(path), shape=shape, chunks=chunks, dtype=dtype,
+                                 compressors=[codec], overwrite=True)
+    from numcodecs import Blosc
+    codec = Blosc(cname="zstd", clevel=clevel, shuffle=Blosc.SHUFFLE if shuffle else Blosc.NOSHUFFLE)
+    return zarr.open_array(str(path), mode="w", shape=shape, chunks=chunks, dtype=dtype,
+                           compressor=codec)
+
+
+def _hdf5_dataset(path, shape, dtype, chunks, clevel, shuffle):
+    import h5py
+    h5file = h5py.File(path, "w")
+    try:
+        import hdf5plugin
+        compression = hdf5plugin.Blosc(cname="zstd", clevel=clevel,
+                                       shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle
+                                       else hdf5plugin.Blosc.NOSHUFFLE)
+        dset = h5file.create_dataset("cube", shape=shape, dtype=dtype, chunks=chunks,
+                                     **compression)
+    except ImportError:
+        # built-in filters only: fast lzf plus the HDF5 byte shuffle
+        dset = h5file.create_dataset("cube", shape=shape, dtype=dtype, chunks=chunks,
+                                     compression="lzf", shuffle=shuffle)
+    return dset, h5file
+
+
+def open_store(kind, path, shape, dtype, chunks, clevel=3, shuffle=True):
+    """
+    New (shape, dtype) workspace of kind "memmap" (raw file, path.dat),
+    "zarr" (path.zarr) or "hdf5" (path.h5), the last two chunked with
+    chunks and compressed with blosc/zstd at clevel, with the byte shuffle
+    if shuffle (lzf + shuffle for HDF5 without hdf5plugin).
+    """
+    path = Path(path)
+    if kind == "memmap":
+        return np.memmap(path.with_suffix(".dat"), dtype=dtype, mode="w+", shape=shape)
+    chunks = tuple(min(c, s) for c, s in zip(chunks, shape))
+    if kind == "zarr":
+        path = path.with_suffix(".zarr")
+        return ChunkedArray(_zarr_array(path, shape, dtype, chunks, clevel, shuffle), path)
+    if kind == "hdf5":
+        path = path.with_suffix(".h5")
+        dset, h5file = _hdf5_dataset(path, shape, dtype, chunks, clevel, shuffle)
+        return ChunkedArray(dset, path, h5file)
+    raise ValueError(f"The stores alowed are {', '.join(STORES)}")
+
+
+def store_path(array):
+    """
+    File or directory backing a workspace returned by open_store.
+    """
+    if isinstance(array, ChunkedArray):
+        return Path(array.path)
+    return Path(array.filename)
+
+
+def disk_bytes(path):
+    """
+    Bytes actually allocated on disk by a file or a directory tree.
+    """
+    path = Path(path)
+    if path.is_file():
+        return os.stat(path).st_blocks * 512
+    return sum(os.stat(os.path.join(root, f)).st_blocks * 512
+               for root, _, files in os.walk(path) for f in files)
+
+
+def remove_store(path):
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        os.remove(path)
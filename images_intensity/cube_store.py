@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Cubo (T, H, W) de los recortes escrito directamente por el preprocesado.
+
+En vez de (o además de) un dr_crop_*.fits por imagen, parallel_preprocess.py
+reserva un cubo en disco junto a OUTPUT_DIR (<OUTPUT_DIR>.npy, memmap, o
+<OUTPUT_DIR>.zarr, un chunk por imagen) y cada proceso escribe sus
+recortes en su posición temporal (el índice del archivo en la lista
+ordenada). Al lado va la tabla <OUTPUT_DIR>.frames.json con, por imagen,
+el archivo de entrada, su T_OBS (tal cual en su cabecera), DATE-OBS, EXPTIME y la WCS del recorte
+(null mientras la imagen no se ha escrito), así que las etapas siguientes
+abren el cubo sin leer ningún FITS (p. ej. NpyCube en filtering_algorithm).
+"""
+import json
+import os
+import shutil
+import numpy as np
+from astropy.io import fits
+from sunpy.map import Map
+
+CUBE_KINDS = ("npy", "zarr")
+
+# Claves de la cabecera guardadas por imagen en la tabla
+HEADER_KEYS = ("date-obs", "exptime", "ctype1", "ctype2", "cunit1", "cunit2",
+               "crpix1", "crpix2", "crval1", "crval2", "cdelt1", "cdelt2", "crota2",
+               "pc1_1", "pc1_2", "pc2_1", "pc2_2", "rsun_ref", "rsun_obs",
+               "dsun_obs", "hgln_obs", "hglt_obs", "crln_obs", "crlt_obs")
+
+
+def cube_path(out_dir, kind):
+    if kind not in CUBE_KINDS:
+        raise ValueError(f"The cube kinds alowed are {', '.join(CUBE_KINDS)}")
+    return os.path.normpath(out_dir) + "." + kind
+
+
+def table_path(path):
+    return os.path.splitext(path)[0] + ".frames.json"
+
+
+def create_cube(path, shape, dtype=np.float32):
+    if path.endswith(".zarr"):
+        import zarr
+        zarr.open_array(path, mode="w", shape=shape, chunks=(1,) + tuple(shape[1:]),
+                        dtype=dtype, fill_value=np.nan)
+    else:
+        cube = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+        cube.flush()
+        del cube
+
+
+def open_cube(path, mode="r"):
+    """
+    Cubo de create_cube como array (memmap o zarr); mode "r" o "r+".
+    """
+    if path.endswith(".zarr"):
+        import zarr
+        return zarr.open_array(path, mode=mode)
+    return np.load(path, mmap_mode=mode)
+
+
+def header_t_obs(path):
+    """
+    T_OBS tal cual en la cabecera de la imagen del FITS path (None si no
+    la tiene), sin cargar la imagen.
+    """
+    with fits.open(path) as hdul:
+        for hdu in hdul:
+            if hdu.header.get("T_OBS"):
+                return hdu.header["T_OBS"]
+    return None
+
+
+def frame_row(smap, fname, t_obs=None):
+    """
+    Fila de la tabla para el recorte smap del archivo fname. DATE-OBS es
+    la del observador de referencia (la de la cabecera del recorte) y
+    T_OBS la de la cabecera del archivo original, sin convertir (t_obs;
+    None si no la tiene).
+    """
+    row = {"file": fname, "T_OBS": t_obs}
+    for key in HEADER_KEYS:
+        if key in smap.meta:
+            value = smap.meta[key]
+            row[key.upper()] = value.item() if hasattr(value, "item") else value
+    return row
+
+
+def load_table(path):
+    path = table_path(path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_table(path, table):
+    path = table_path(path)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(table, f, indent=1)
+    os.replace(tmp, path)
+
+
+def fingerprint(entry):
+    """
+    Huella de un archivo de entrada en el manifiesto (tamaño, mtime y
+    sha1 si lo hay), sin su recorte.
+    """
+    return {key: value for key, value in entry.items() if key != "output"}
+
+
+def prepare_cube(path, files, dims, done=None, dtype=np.float32, params_hash=None):
+    """
+    Cubo y tabla para la lista ordenada files con recortes de dims
+    píxeles hechos con los parámetros params_hash (Manifest.hash). Se
+    reutilizan si ya existen para los mismos archivos, dims y parámetros.
+    Si no, se crean de nuevo con las imágenes de los archivos ya procesados
+    (done: {archivo de entrada: su entrada del manifiesto}): copiadas del
+    cubo anterior si estaban en él con la misma huella (fingerprint) y
+    parámetros, o si no desde su recorte FITS, con la T_OBS de la cabecera
+    del archivo de entrada (header_t_obs).
+
+    Devuelve la tabla y los archivos cuya imagen falta en el cubo.
+    """
+    files = [os.path.abspath(f) for f in files]
+    shape = [len(files)] + [int(d) for d in dims]
+    table = load_table(path)
+    if (table is None or table["cube"] != os.path.basename(path) or not os.path.exists(path)
+            or table["files"] != files or table["shape"] != shape
+            or table.get("params_hash") != params_hash):
+        # Imágenes del cubo anterior que se pueden conservar
+        previous, old_cube = {}, None
+        if (table is not None and table["cube"] == os.path.basename(path) and os.path.exists(path)
+                and table["shape"][1:] == shape[1:] and table.get("params_hash") == params_hash):
+            old_cube = open_cube(path)
+            prints = table.get("fingerprints") or [None]*len(table["files"])
+            previous = {f: (n, row, fp) for n, (f, row, fp)
+                        in enumerate(zip(table["files"], table["frames"], prints))
+                        if row is not None and fp is not None}
+
+        root, ext = os.path.splitext(path)
+        tmp = root + ".tmp" + ext
+        create_cube(tmp, tuple(shape), dtype)
+        table = {"cube": os.path.basename(path), "shape": shape, "dtype": np.dtype(dtype).name,
+                 "params_hash": params_hash, "files": files, "frames": [None]*len(files),
+                 "fingerprints": [None]*len(files)}
+        done = {os.path.abspath(f): entry for f, entry in (done or {}).items()}
+        cube = open_cube(tmp, "r+")
+        for n, f in enumerate(files):
+            if f not in done:
+                continue
+            fp = fingerprint(done[f])
+            out = done[f].get("output")
+            if f in previous and previous[f][2] == fp:
+                old_n, row, _ = previous[f]
+                cube[n] = old_cube[old_n]
+                table["frames"][n], table["fingerprints"][n] = row, fp
+            elif out and out.endswith(".fits") and os.path.exists(out):
+                smap = Map(out)
+                if smap.data.shape == tuple(shape[1:]):
+                    cube[n] = smap.data
+                    table["frames"][n] = frame_row(smap, os.path.basename(f), header_t_obs(f))
+                    table["fingerprints"][n] = fp
+        if hasattr(cube, "flush"):
+            cube.flush()
+        del cube, old_cube
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+        save_table(path, table)
+    missing = [f for f, row in zip(files, table["frames"]) if row is None]
+    return table, missing
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Rotación diferencial restringida a la ventana de recorte.
+
+differential_rotate(smap, observer) calcula la transformación de
+coordenadas y la interpolación para los 4096² píxeles del disco, y después
+solo se conservan los de la ventana ±CROP_LIM (≈6 % del disco para
+±500″). rotate_crop hace la misma operación (misma rejilla de salida,
+mismo modelo de rotación, interpolación bilineal, NaN fuera del disco)
+pero solo sobre los píxeles de la ventana, leyendo de smap únicamente la
+región (con un margen) de la que provienen.
+"""
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from sunpy.coordinates import (Heliocentric, HeliographicStonyhurst, Helioprojective,
+                               transform_with_sun_center)
+from sunpy.map import Map
+from sunpy.map.header_helper import get_observer_meta
+from sunpy.physics.differential_rotation import differential_rotate
+from sunpy.sun.models import differential_rotation
+from sunpy.time import parse_time
+
+MARGIN_PIX    = 2   # píxeles extra alrededor de la región fuente (interpolación bilineal)
+OBSERVER_KEYS = ("hgln_obs", "hglt_obs", "crln_obs", "crlt_obs", "dsun_obs")
+
+
+def observation_date(path):
+    """
+    Fecha de observación del FITS path (la de Map(path).date: DATE-OBS, o
+    T_OBS si no la hay) leída de las cabeceras, sin cargar la imagen.
+    """
+    with fits.open(path) as hdul:
+        for hdu in hdul:
+            for key in ("DATE-OBS", "DATE_OBS", "T_OBS"):
+                if hdu.header.get(key):
+                    return parse_time(hdu.header[key])
+    return parse_time(Map(path).date)
+
+
+def crop_window(smap, crop_lim):
+    """
+    Submap ±crop_lim de smap: la rejilla de salida de la ventana, la misma
+    que tiene la ventana del mapa rotado (differential_rotate conserva la
+    rejilla de píxeles del disco completo).
+    """
+    bl = SkyCoord(-crop_lim, -crop_lim, frame=smap.coordinate_frame)
+    tr = SkyCoord( crop_lim,  crop_lim, frame=smap.coordinate_frame)
+    return smap.submap(bottom_left=bl, top_right=tr)
+
+
+def source_pixels(crop, smap, observer):
+    """
+    Píxeles (x, y) de smap de los que proviene cada píxel de crop rotado
+    hasta observer (NaN para los que quedan detrás del disco), con el mismo
+    modelo que differential_rotate.
+    """
+    ny, nx = crop.data.shape
+    yy, xx = np.mgrid[:ny, :nx]
+    coord = crop.wcs.pixel_to_world(xx, yy)
+    out_hpc = SkyCoord(coord.Tx, coord.Ty, obstime=observer.obstime,
+                       observer=observer, frame=Helioprojective)
+    hgs = out_hpc.transform_to(HeliographicStonyhurst)
+
+    # Se deshace la rotación entre la fecha del mapa y la del observador
+    interval = (parse_time(observer.obstime) - parse_time(smap.date)).to(u.s)
+    drot = differential_rotation(interval, hgs.lat.to(u.degree))
+    rotated = SkyCoord(hgs.lon - drot, hgs.lat, hgs.radius,
+                       obstime=hgs.obstime, frame=HeliographicStonyhurst)
+    with transform_with_sun_center():
+        behind = rotated.transform_to(
+            Heliocentric(observer=smap.observer_coordinate)).z.value < 0
+        back = rotated.transform_to(smap.coordinate_frame)
+
+    x, y = smap.wcs.world_to_pixel(back)
+    x, y = np.array(x, dtype=float), np.array(y, dtype=float)
+    x[behind] = np.nan
+    y[behind] = np.nan
+    return x, y
+
+
+def rotated_meta(crop, observer):
+    """
+    Cabecera de la ventana con el observador observer en lugar del suyo.
+    """
+    meta = crop.meta.copy()
+    for key in OBSERVER_KEYS:
+        meta.pop(key, None)
+    meta.update(get_observer_meta(observer, crop.rsun_meters))
+    return meta
+
+
+def rotated_map(crop, data, observer):
+    """
+    Mapa (del mismo tipo que crop) con los datos rotados hasta observer:
+    observador, fecha y fecha de referencia (T_OBS en HMI, que fija el
+    obstime de la WCS) de observer, como en la salida de differential_rotate.
+    """
+    out = crop._new_instance(data, rotated_meta(crop, observer), crop.plot_settings)
+    out._set_date(observer.obstime)
+    out._set_reference_date(observer.obstime)
+    return out
+
+
+def rotate_crop(smap, observer, crop_lim, margin=MARGIN_PIX):
+    """
+    Equivalente a differential_rotate(smap, observer=observer) seguido del
+    submap ±crop_lim, calculado solo en la ventana.
+    """
+    from skimage import transform
+
+    crop = crop_window(smap, crop_lim)
+    x, y = source_pixels(crop, smap, observer)
+
+    # Región de smap que alimenta la ventana (submap con margen)
+    ny, nx = smap.data.shape
+    if np.isfinite(x).any():
+        x0 = max(int(np.floor(np.nanmin(x))) - margin, 0)
+        x1 = min(int(np.ceil(np.nanmax(x))) + margin + 1, nx)
+        y0 = max(int(np.floor(np.nanmin(y))) - margin, 0)
+        y1 = min(int(np.ceil(np.nanmax(y))) + margin + 1, ny)
+    else:
+        x0, x1, y0, y1 = 0, 1, 0, 1   # ventana entera fuera del disco
+    source = smap.data[y0:y1, x0:x1]
+
+    # Interpolación bilineal, igual que el warp de differential_rotate
+    coords = np.array([y - y0, x - x0])
+    data = transform.warp(source, inverse_map=coords, output_shape=crop.data.shape,
+                          preserve_range=True, cval=np.nan)
+    return rotated_map(crop, data, observer)
+
+
+def rotate_and_crop(smap, observer, crop_lim, crop_first=True):
+    """
+    Ventana ±crop_lim de smap rotada diferencialmente hasta observer:
+    con rotate_crop (crop_first=True) o rotando el disco completo y
+    recortando después (crop_first=False, la ruta original).
+    """
+    if crop_first:
+        return rotate_crop(smap, observer, crop_lim)
+    m_rot = differential_rotate(smap, observer=observer)
+    bl = SkyCoord(-crop_lim, -crop_lim, frame=m_rot.coordinate_frame)
+    tr = SkyCoord( crop_lim,  crop_lim, frame=m_rot.coordinate_frame)
+    return m_rot.submap(bottom_left=bl, top_right=tr)
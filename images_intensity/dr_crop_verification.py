@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Comprueba que rotate_crop (recorte antes de rotar) reproduce la ruta
+original (differential_rotate del disco completo + submap ±CROP_LIM) sobre
+mapas sintéticos tipo HMI (datos y cabecera, con T_OBS, la fecha de
+referencia de la WCS), y compara el tiempo por imagen.
+
+Tolerancia: ambas rutas usan la misma rejilla, el mismo modelo de rotación
+y la misma interpolación bilineal, así que la diferencia máxima relativa
+debe ser de redondeo (TOL); los NaN (fuera del disco) deben coincidir.
+"""
+import time
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from sunpy.coordinates import frames, get_earth
+from sunpy.map import Map, make_fitswcs_header
+from sunpy.time import parse_time
+
+from dr_crop import rotate_and_crop
+
+N        = 1024            # píxeles por lado del disco sintético
+CDELT    = 2.0             # arcsec/píxel
+CROP_LIM = 500 * u.arcsec
+TOL      = 1e-6
+REF_DATE = "2024-01-01T00:00:00"
+EXPTIME  = 45.             # s
+
+
+def synthetic_map(date, rotation=0*u.deg, seed=0):
+    """
+    Disco sintético de N×N píxeles (HMIMap): patrón de granulación fijo +
+    ruido, cero fuera del limbo.
+    """
+    observer = get_earth(date)
+    ref = SkyCoord(0*u.arcsec, 0*u.arcsec, obstime=date, observer=observer,
+                   frame=frames.Helioprojective)
+    header = make_fitswcs_header((N, N), ref, scale=[CDELT, CDELT]*u.arcsec/u.pix,
+                                 rotation_angle=rotation, telescope="SDO/HMI",
+                                 instrument="HMI_SIDE1", exposure=EXPTIME*u.s)
+    # Como en HMI: T_OBS (fecha de referencia de la WCS) en el centro de la exposición
+    header["t_obs"] = (parse_time(date) + EXPTIME/2*u.s).isot
+    header["content"] = "CONTINUUM INTENSITY"
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:N, :N]
+    data = 1e4 + 500*np.sin(x/7.)*np.cos(y/5.) + 100*rng.standard_normal((N, N))
+    data[np.hypot(x-(N-1)/2, y-(N-1)/2)*CDELT > 959] = 0
+    return Map(data.astype(np.float32), header)
+
+
+if __name__ == "__main__":
+    observer = synthetic_map(REF_DATE).observer_coordinate
+    ok = True
+    for date in ["2024-01-01T00:00:45", "2024-01-01T03:00:00", "2024-01-01T12:00:00"]:
+        for rotation in [0*u.deg, 180*u.deg]:
+            smap = synthetic_map(date, rotation)
+            t0 = time.time()
+            full = rotate_and_crop(smap, observer, CROP_LIM, crop_first=False)
+            t1 = time.time()
+            crop = rotate_and_crop(smap, observer, CROP_LIM, crop_first=True)
+            t2 = time.time()
+
+            same_nan = np.array_equal(np.isnan(full.data), np.isnan(crop.data))
+            diff = np.nanmax(np.abs(full.data - crop.data))/np.nanmax(np.abs(full.data))
+            same_meta = type(full) is type(crop) and dict(full.meta) == dict(crop.meta)
+            good = full.data.shape == crop.data.shape and same_nan and diff <= TOL and same_meta
+            ok = ok and good
+            print(f"{date} rot={rotation.value:.0f}: dif. relativa {diff:.2e}, "
+                  f"NaN iguales {same_nan}, cabeceras iguales {same_meta}, disco completo {t1-t0:.2f} s, "
+                  f"recorte {t2-t1:.2f} s -> {'OK' if good else 'FALLO'}")
+
+    print("Verificación superada" if ok else "Verificación fallida")
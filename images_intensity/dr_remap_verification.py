@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Comprueba RotationRemap (dr_remap.py) frente a rotate_crop (dr_crop.py)
+sobre una serie sintética de 4 h: error de los píxeles fuente interpolados
+entre anclas (≤ TOL_PIX con anclas cada hora), mismos NaN, anclas de la
+serie con un hueco de GAP imágenes (a ambos lados del hueco), rotación exacta
+(rotate_crop) de una imagen con la rejilla desplazada, y tiempo por imagen.
+"""
+import os
+import tempfile
+import time
+import numpy as np
+from sunpy.map import Map
+
+from dr_crop import crop_window, rotate_crop, source_pixels
+from dr_crop_verification import CROP_LIM, synthetic_map
+from dr_remap import ANCHOR_STEP, RotationRemap
+
+STEP_MIN = 15          # minutos entre imágenes de la serie sintética
+N_FRAMES = 17          # 4 h
+TOL_PIX  = 0.05
+GAP      = slice(5, 11)   # imágenes quitadas para la serie con hueco (1:15 a 2:30)
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i in range(N_FRAMES):
+            minutes = i*STEP_MIN
+            date = f"2024-01-01T{minutes//60:02d}:{minutes%60:02d}:00"
+            path = os.path.join(tmp, f"frame_{i:03d}.fits")
+            synthetic_map(date, seed=i).save(path, overwrite=True)
+            files.append(path)
+        observer = Map(files[0]).observer_coordinate
+
+        t0 = time.time()
+        remap = RotationRemap.build(files, observer, CROP_LIM, os.path.join(tmp, "remap.npy"))
+        print(f"Anclas calculadas en {time.time()-t0:.2f} s")
+
+        ok = True
+        t_exact = t_remap = 0.
+        for path in files:
+            smap = Map(path)
+            x, y = source_pixels(crop_window(smap, CROP_LIM), smap, observer)
+            xi, yi = remap.source_pixels(smap.date)
+            err = np.nanmax(np.hypot(x - xi, y - yi))
+
+            t0 = time.time()
+            exact = rotate_crop(smap, observer, CROP_LIM)
+            t1 = time.time()
+            fast = remap.rotate_crop(smap)
+            t2 = time.time()
+            t_exact += t1 - t0
+            t_remap += t2 - t1
+
+            same_nan = np.array_equal(np.isnan(exact.data), np.isnan(fast.data))
+            good = err <= TOL_PIX and same_nan
+            ok = ok and good
+            print(f"{smap.date.isot}: error {err:.4f} px, NaN iguales {same_nan} "
+                  f"-> {'OK' if good else 'FALLO'}")
+
+        # Serie con hueco: anclas como mucho a ANCHOR_STEP salvo a ambos lados del hueco
+        gap_files = files[:GAP.start] + files[GAP.stop:]
+        gap = RotationRemap.build(gap_files, observer, CROP_LIM, os.path.join(tmp, "gap.npy"))
+        dates = [(Map(path).date - gap.t0).to_value("s") for path in gap_files]
+        step = ANCHOR_STEP.to_value("s")
+        spaced = all(b - a <= step + 1e-3 or not any(a + 1 < d < b - 1 for d in dates)
+                     for a, b in zip(gap.times[:-1], gap.times[1:]))
+        ok = ok and spaced
+        print(f"Serie con hueco: anclas a {np.round(np.array(gap.times)/60).astype(int)} min "
+              f"-> {'OK' if spaced else 'FALLO'}")
+
+        # Rejilla desplazada 0.3 px: debe rotarse con rotate_crop
+        smap = Map(files[N_FRAMES//2])
+        meta = smap.meta.copy()
+        meta["crpix1"] += 0.3
+        shifted = Map(smap.data, meta)
+        same = np.array_equal(remap.rotate_crop(shifted).data,
+                              rotate_crop(shifted, observer, CROP_LIM).data, equal_nan=True)
+        ok = ok and same
+        print(f"Rejilla desplazada rotada con rotate_crop: {same}")
+
+        print(f"Tiempo medio por imagen: rotate_crop {t_exact/N_FRAMES:.3f} s, "
+              f"RotationRemap {t_remap/N_FRAMES:.3f} s")
+        print("Verificación superada" if ok else "Verificación fallida")
@@ -5,7 +5,20 @@ import glob
 import numpy as np
 from sunpy.map import Map
 
+from cube_store import load_table
+
 INPUT_DIR = "./data_hmi_Ic_45s_crop_dr/"
+INPUT_CUBE = "./data_hmi_Ic_45s_crop_dr.npy"   # cubo del preprocesado (OUTPUT_CUBE); .npy o .zarr
+
+# -------- CUBO DEL PREPROCESADO: dimensiones fijas, solo se mira la tabla --------
+table = load_table(INPUT_CUBE) if os.path.exists(INPUT_CUBE) else None
+if table is not None:
+    missing = [f for f, row in zip(table["files"], table["frames"]) if row is None]
+    print("Forma del cubo:", tuple(table["shape"]))
+    for f in missing:
+        print("Sin escribir:", f)
+    print(f"{len(table['files']) - len(missing)} de {len(table['files'])} imágenes escritas")
+    raise SystemExit
 
 # -------- LEER IMÁGENES Y CREAR CUBO --------
 fits_files = sorted(glob.glob(os.path.join(INPUT_DIR, "*.fits")))
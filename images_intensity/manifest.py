@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Manifiesto del preprocesado: qué archivos de entrada ya tienen su recorte
+en OUTPUT_DIR y con qué parámetros, para que una nueva ejecución procese
+solo los archivos nuevos o modificados.
+
+Se guarda como JSON junto a OUTPUT_DIR (<OUTPUT_DIR>.manifest.json) con
+los parámetros (y su hash) y, por archivo de entrada, tamaño, mtime (y
+sha1 si use_hash), y el recorte FITS generado (null si la imagen solo
+se escribió en el cubo de cube_store.py, que guarda en su tabla el hash
+de los parámetros con que se hizo). Si cambian los parámetros (CROP_LIM,
+observador de referencia, ...) se borran los recortes FITS anteriores y
+se empieza de cero.
+"""
+import hashlib
+import json
+import os
+
+import astropy.units as u
+
+
+def manifest_path(out_dir):
+    return os.path.normpath(out_dir) + ".manifest.json"
+
+
+def preprocess_params(crop_lim, observer, dims, **options):
+    """
+    Parámetros que determinan los recortes, serializables en JSON.
+    """
+    params = {
+        "crop_lim_arcsec": float(crop_lim.to_value(u.arcsec)),
+        "observer": {"lon_deg": float(observer.lon.to_value(u.deg)),
+                     "lat_deg": float(observer.lat.to_value(u.deg)),
+                     "radius_m": float(observer.radius.to_value(u.m)),
+                     "obstime": observer.obstime.isot},
+        "dims": [int(d) for d in dims],
+    }
+    params.update(options)
+    return params
+
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def file_sha1(path, block=2**22):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(block), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    manifest = Manifest(out_dir, params)
+    for path in manifest.pending(files): ...; manifest.record(path, out); manifest.save()
+    """
+    def __init__(self, out_dir, params, use_hash=False):
+        self.path = manifest_path(out_dir)
+        self.params = params
+        self.hash = params_hash(params)
+        self.use_hash = use_hash
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                old = json.load(f)
+            if old.get("params_hash") == self.hash:
+                self.entries = old.get("files", {})
+            else:
+                self._invalidate(old.get("files", {}))
+
+    def _invalidate(self, entries):
+        """
+        Borra los recortes FITS hechos con otros parámetros.
+        """
+        print(f"→ Parámetros distintos a los del manifiesto: se rehacen {len(entries)} recortes")
+        outputs = {entry.get("output") for entry in entries.values()}
+        for output in outputs:
+            if output and os.path.isfile(output):
+                os.remove(output)
+        self.save()
+
+    def fingerprint(self, path):
+        st = os.stat(path)
+        entry = {"size": st.st_size, "mtime": st.st_mtime}
+        if self.use_hash:
+            entry["sha1"] = file_sha1(path)
+        return entry
+
+    def is_done(self, path):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry is None:
+            return False
+        if entry.get("output") and not os.path.exists(entry["output"]):
+            return False
+        current = self.fingerprint(path)
+        return all(entry.get(key) == value for key, value in current.items())
+
+    def pending(self, files):
+        """
+        Archivos de files sin recorte válido (nuevos, modificados o sin salida).
+        """
+        return [path for path in files if not self.is_done(path)]
+
+    def record(self, path, output=None):
+        """
+        path procesado; output es su recorte FITS (None si solo va al cubo).
+        """
+        entry = self.fingerprint(path)
+        entry["output"] = os.path.abspath(output) if output else None
+        self.entries[os.path.abspath(path)] = entry
+
+    def save(self):
+        """
+        Escribe el manifiesto en un temporal y lo renombra (os.replace): una
+        interrupción durante la escritura no deja un JSON truncado.
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"params": self.params, "params_hash": self.hash,
+                       "files": self.entries}, f, indent=1)
+        os.replace(tmp, self.path)
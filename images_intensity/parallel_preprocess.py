@@ -1,80 +1,214 @@
 #!/usr/bin/env python3
 import os
 import glob
+import time
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 from sunpy.map import Map
-from sunpy.physics.differential_rotation import differential_rotate
 from sunpy.time import parse_time
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from dr_crop import rotate_and_crop
+from dr_remap import RotationRemap
+from manifest import Manifest, preprocess_params
+from cube_store import (cube_path, fingerprint, frame_row, open_cube, prepare_cube,
+                        save_table)
 
 # -------- CONFIGURACIÓN --------
 INPUT_DIR  = "data_hmi_Ic_45s/"
 OUTPUT_DIR = "data_hmi_Ic_45s_crop_dr/"
 CROP_LIM   = 500 * u.arcsec   # ±500 arcsec en X e Y
+CROP_FIRST = True             # False: rotar el disco completo y recortar después (ruta original)
+REMAP      = True             # con CROP_FIRST: mapeo de rotación en anclas interpolado (dr_remap.py)
+WORKERS    = None             # procesos (None: núcleos de CPU)
+CHUNK      = 4                # archivos por tarea
+INFLIGHT   = 2                # tareas en curso por proceso (ventana acotada)
+HASH_INPUTS = False           # manifiesto: comparar también el sha1 de cada entrada (más lento)
+SAVE_EVERY = 50               # manifiesto y tabla del cubo: guardar cada SAVE_EVERY imágenes (y al final)
+OUTPUT_FITS = True            # un dr_crop_*.fits por imagen
+OUTPUT_CUBE = None            # "npy" o "zarr": cubo <OUTPUT_DIR>.npy/.zarr con tabla de fechas y WCS (cube_store.py)
+
+# Variables que limitan a 1 los hilos de numpy/BLAS de cada proceso
+THREAD_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+               "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Estado de cada proceso, fijado una sola vez por init_worker
+_STATE = {}
 
-# Listado de archivos y referencia
-fits_files   = sorted(glob.glob(os.path.join(INPUT_DIR, "*.fits")))
-if not fits_files:
-    raise FileNotFoundError(f"No FITS found in {INPUT_DIR}")
 
-first_map    = Map(fits_files[0])
-ref_observer = first_map.observer_coordinate
+def reference(files, crop_lim):
+    """
+    Observador de referencia (el de la primera imagen) y dimensiones en
+    píxeles de su ventana ±crop_lim, comunes a todos los recortes.
+    """
+    first_map = Map(files[0])
+    bl_s = SkyCoord(-crop_lim, -crop_lim, frame=first_map.coordinate_frame)
+    tr_s = SkyCoord( crop_lim,  crop_lim, frame=first_map.coordinate_frame)
+    sample = first_map.submap(bottom_left=bl_s, top_right=tr_s)
+    return first_map.observer_coordinate, sample.data.shape
 
-# Muestra para fijar dimensiones de píxeles
-bl_s = SkyCoord(-CROP_LIM, -CROP_LIM, frame=first_map.coordinate_frame)
-tr_s = SkyCoord( CROP_LIM,  CROP_LIM, frame=first_map.coordinate_frame)
-sample = first_map.submap(bottom_left=bl_s, top_right=tr_s)
-ny_ref, nx_ref = sample.data.shape
-total = len(fits_files)
-print(f"→ Cada recorte será {ny_ref}×{nx_ref} píxeles (ventana fija)")
 
-def process_file(path, observer, out_dir, crop_lim, dims, idx, total):
+def process_file(path, observer, out_dir, crop_lim, dims, remap=None, cube=None, n=None,
+                 crop_first=True, output_fits=True):
     """
-    Lee, rota, recorta, remuestrea y guarda un FITS.
+    Lee, rota, recorta, remuestrea y guarda un FITS (con output_fits) y/o
+    la imagen n de cube. Devuelve la ruta del FITS (o None) y la fila de
+    la tabla del cubo (o None).
     """
     fname = os.path.basename(path)
-    prog  = (idx + 1) / total * 100
-    print(f"[{idx+1}/{total}] {prog:.1f}% – {fname}")
 
-    # 1) Leer y rotar diferencialmente
+    # 1) Leer, rotar diferencialmente y extraer submap helioprojectivo
+    #    (con crop_first solo se rota la ventana, ver dr_crop.py; con remap,
+    #    interpolando el mapeo de las anclas, ver dr_remap.py)
     smap  = Map(path)
-    m_rot = differential_rotate(smap, observer=observer)
+    if remap is not None:
+        m_sub = remap.rotate_crop(smap)
+    else:
+        m_sub = rotate_and_crop(smap, observer, crop_lim, crop_first=crop_first)
 
-    # 2) Definir esquinas en coordenadas
-    bl = SkyCoord(-crop_lim, -crop_lim, frame=m_rot.coordinate_frame)
-    tr = SkyCoord( crop_lim,  crop_lim, frame=m_rot.coordinate_frame)
+    # 2) Remuestrear a la forma fija en píxeles
+    m_crop = m_sub.resample((dims[0], dims[1]) * u.pix)
 
-    # 3) Extraer submap helioprojectivo
-    m_sub = m_rot.submap(bottom_left=bl, top_right=tr)
+    # 3) Conservar fecha original
+    m_crop.meta['DATE-OBS'] = parse_time(m_sub.date).isot
 
-    # 4) Remuestrear a la forma fija en píxeles
-    m_crop = m_sub.resample((dims[0], dims[1]) * u.pix)
+    # 4) Guardar FITS y/o escribir en el cubo
+    out_path = None
+    if output_fits:
+        out_path = os.path.join(out_dir, f"dr_crop_{fname}")
+        m_crop.save(out_path, overwrite=True)
+    row = None
+    if cube is not None:
+        cube[n] = m_crop.data
+        row = frame_row(m_crop, fname, smap.meta.get("t_obs"))
+
+    return out_path, row
+
+
+def init_worker(observer, out_dir, crop_lim, dims, remap, cube, crop_first, output_fits):
+    """
+    Estado común de cada proceso (se recibe una sola vez, no en cada
+    tarea; toda la configuración llega por aquí, no por las variables del
+    módulo, que cada proceso spawn vuelve a importar) y un hilo de
+    numpy/BLAS por proceso.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+        _STATE["threads"] = threadpool_limits(limits=1)
+    except ImportError:
+        pass   # bastan las THREAD_VARS, heredadas por los procesos (spawn)
+    _STATE.update(observer=observer, out_dir=out_dir, crop_lim=crop_lim,
+                  dims=dims, remap=remap, cube=open_cube(cube, "r+") if cube else None,
+                  crop_first=crop_first, output_fits=output_fits)
+
+
+def process_chunk(items):
+    """
+    Procesa un bloque de archivos (índice en la serie, ruta) con el estado
+    del proceso.
+    """
+    results = []
+    for n, path in items:
+        out_path, row = process_file(path, _STATE["observer"], _STATE["out_dir"],
+                                     _STATE["crop_lim"], _STATE["dims"], _STATE["remap"],
+                                     _STATE["cube"], n, _STATE["crop_first"],
+                                     _STATE["output_fits"])
+        results.append((n, path, out_path, row))
+    if hasattr(_STATE["cube"], "flush"):
+        _STATE["cube"].flush()
+    return results
+
+
+def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    # Listado de archivos y referencia
+    fits_files = sorted(glob.glob(os.path.join(INPUT_DIR, "*.fits")))
+    if not fits_files:
+        raise FileNotFoundError(f"No FITS found in {INPUT_DIR}")
+    ref_observer, dims = reference(fits_files, CROP_LIM)
+    print(f"→ Cada recorte será {dims[0]}×{dims[1]} píxeles (ventana fija)")
+
+    # Solo los archivos nuevos o modificados desde la última ejecución
+    params   = preprocess_params(CROP_LIM, ref_observer, dims, crop_first=CROP_FIRST,
+                                 remap=CROP_FIRST and REMAP, fits=OUTPUT_FITS)
+    manifest = Manifest(OUTPUT_DIR, params, use_hash=HASH_INPUTS)
+    todo     = manifest.pending(fits_files)
+
+    # Cubo de salida: se añaden las imágenes que le faltan
+    cube = table = None
+    if OUTPUT_CUBE:
+        cube = cube_path(OUTPUT_DIR, OUTPUT_CUBE)
+        pending = set(todo)
+        done_entries = {path: manifest.entries[os.path.abspath(path)]
+                        for path in fits_files if path not in pending}
+        table, missing = prepare_cube(cube, fits_files, dims, done_entries, params_hash=manifest.hash)
+        missing = set(missing)
+        todo = [path for path in fits_files
+                if path in pending or os.path.abspath(path) in missing]
+    total    = len(todo)
+    print(f"→ {total} de {len(fits_files)} archivos por procesar")
+    if not todo:
+        print("Nada que hacer. Salida en:", cube or OUTPUT_DIR)
+        return
+
+    # Mapeo de rotación precalculado (se comparte con los procesos vía mmap)
+    remap = None
+    if CROP_FIRST and REMAP:
+        remap = RotationRemap.build(todo, ref_observer, CROP_LIM,
+                                    os.path.join(OUTPUT_DIR, "dr_remap.npy"))
 
-    # 5) Conservar fecha original
-    m_crop.meta['DATE-OBS'] = parse_time(m_rot.date).isot
+    # Procesos nuevos (spawn) que heredan un hilo por proceso
+    for var in THREAD_VARS:
+        os.environ[var] = "1"
+    workers = WORKERS or os.cpu_count() or 4
+    index   = {path: n for n, path in enumerate(fits_files)}
+    items   = [(index[path], path) for path in todo]
+    chunks  = iter([items[i:i+CHUNK] for i in range(0, total, CHUNK)])
+    done    = 0
+    saved   = 0
+    t0      = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                                 initializer=init_worker,
+                                 initargs=(ref_observer, OUTPUT_DIR, CROP_LIM, dims, remap, cube,
+                                           CROP_FIRST, OUTPUT_FITS)) as exe:
+            pending = set()
+            while True:
+                # Como mucho INFLIGHT bloques por proceso en cola
+                while len(pending) < workers*INFLIGHT:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    pending.add(exe.submit(process_chunk, chunk))
+                if not pending:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    for n, path, out_path, row in fut.result():
+                        manifest.record(path, out_path)
+                        if table is not None:
+                            table["frames"][n] = row
+                            table["fingerprints"][n] = fingerprint(manifest.entries[os.path.abspath(path)])
+                        done += 1
+                if done - saved >= SAVE_EVERY:
+                    manifest.save()
+                    if table is not None:
+                        save_table(cube, table)
+                    saved = done
+                rate = done/(time.time() - t0)
+                print(f"[{done}/{total}] {done/total*100:.1f}% – {rate:.2f} imágenes/s")
+    finally:
+        # también si se interrumpe: lo ya procesado no se repite
+        manifest.save()
+        if table is not None:
+            save_table(cube, table)
 
-    # 6) Guardar FITS
-    out_path = os.path.join(out_dir, f"dr_crop_{fname}")
-    m_crop.save(out_path, overwrite=True)
+    elapsed = time.time() - t0
+    print(f"Preprocesamiento paralelo finalizado: {total} imágenes en {elapsed:.1f} s "
+          f"({total/elapsed:.2f} imágenes/s, {workers} procesos). Salida en:", cube or OUTPUT_DIR)
 
-    return out_path
 
 if __name__ == "__main__":
-    # Número de procesos = núcleos de CPU
-    workers = os.cpu_count() or 4
-    dims    = (ny_ref, nx_ref)
-    with ProcessPoolExecutor(max_workers=workers) as exe:
-        futures = []
-        for i, f in enumerate(fits_files):
-            futures.append(
-                exe.submit(process_file,
-                           f, ref_observer, OUTPUT_DIR, CROP_LIM, dims, i, total)
-            )
-        for fut in as_completed(futures):
-            res = fut.result()
-            print(res)
-
-    print("Preprocesamiento paralelo finalizado. Salida en:", OUTPUT_DIR)
+    main()
@@ -4,13 +4,20 @@ import glob
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 from sunpy.map import Map
-from sunpy.physics.differential_rotation import differential_rotate
 from sunpy.time import parse_time
 
+from dr_crop import rotate_and_crop
+from dr_remap import RotationRemap
+from manifest import Manifest, preprocess_params
+
 # -------- CONFIGURACIÓN --------
 INPUT_DIR  = "./data_hmi_Ic_45s/"
 OUTPUT_DIR = "./data_hmi_Ic_45s_crop_dr/"
 CROP_LIM   = 500 * u.arcsec   # ±500 arcsec en X e Y
+CROP_FIRST = True             # False: rotar el disco completo y recortar después (ruta original)
+REMAP      = True             # con CROP_FIRST: mapeo de rotación en anclas interpolado (dr_remap.py)
+HASH_INPUTS = False           # manifiesto: comparar también el sha1 de cada entrada (más lento)
+SAVE_EVERY = 50               # manifiesto: guardar cada SAVE_EVERY archivos (y al final)
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
@@ -26,35 +33,53 @@ sample = first_map.submap(bottom_left=bl_s, top_right=tr_s)
 ny_ref, nx_ref = sample.data.shape
 print(f"→ Tamaño fijo de recorte (pixeles): {ny_ref}×{nx_ref}")
 
-def crop_and_save(path, observer, out_dir, crop_lim, idx, total):
+def crop_and_save(path, observer, out_dir, crop_lim, idx, total, remap=None):
     fname = os.path.basename(path)
     prog  = (idx+1)/total*100
     print(f"[{idx+1}/{total}] {prog:.1f}% – {fname}")
 
-    # 1) Leer y rotar diferencialmente
+    # 1) Leer, rotar diferencialmente y hacer submap de la ventana
+    #    helioprojectiva (con CROP_FIRST solo se rota la ventana, ver dr_crop.py;
+    #    con remap, interpolando el mapeo de las anclas, ver dr_remap.py)
     smap  = Map(path)
-    m_rot = differential_rotate(smap, observer=observer)
-
-    # 2) Definir esquinas en coordenadas
-    bl = SkyCoord(-crop_lim, -crop_lim, frame=m_rot.coordinate_frame)
-    tr = SkyCoord( crop_lim,  crop_lim, frame=m_rot.coordinate_frame)
-
-    # 3) Hacer submap de la ventana helioprojectiva
-    m_sub = m_rot.submap(bottom_left=bl, top_right=tr)
+    if remap is not None:
+        m_sub = remap.rotate_crop(smap)
+    else:
+        m_sub = rotate_and_crop(smap, observer, crop_lim, crop_first=CROP_FIRST)
 
-    # 4) Remuestrear a la forma fija en píxeles
+    # 2) Remuestrear a la forma fija en píxeles
     m_crop = m_sub.resample((ny_ref, nx_ref) * u.pix)
 
-    # 5) Mantener la fecha original
-    m_crop.meta['DATE-OBS'] = parse_time(m_rot.date).isot
+    # 3) Mantener la fecha original
+    m_crop.meta['DATE-OBS'] = parse_time(m_sub.date).isot
 
-    # 6) Guardar
+    # 4) Guardar
     out = os.path.join(out_dir, f"dr_crop_{fname}")
     m_crop.save(out, overwrite=True)
+    return out
+
+# Solo los archivos nuevos o modificados desde la última ejecución
+params   = preprocess_params(CROP_LIM, ref_observer, (ny_ref, nx_ref), crop_first=CROP_FIRST,
+                             remap=CROP_FIRST and REMAP, fits=True)
+manifest = Manifest(OUTPUT_DIR, params, use_hash=HASH_INPUTS)
+todo     = manifest.pending(files)
+print(f"→ {len(todo)} de {len(files)} archivos por procesar")
+
+# Mapeo de rotación precalculado para toda la serie
+remap = None
+if todo and CROP_FIRST and REMAP:
+    remap = RotationRemap.build(todo, ref_observer, CROP_LIM,
+                                os.path.join(OUTPUT_DIR, "dr_remap.npy"))
 
-# Ejecutar para todos los archivos
-total = len(files)
-for i, f in enumerate(files):
-    crop_and_save(f, ref_observer, OUTPUT_DIR, CROP_LIM, i, total)
+# Ejecutar para los archivos pendientes
+total = len(todo)
+try:
+    for i, f in enumerate(todo):
+        out = crop_and_save(f, ref_observer, OUTPUT_DIR, CROP_LIM, i, total, remap)
+        manifest.record(f, out)
+        if (i+1) % SAVE_EVERY == 0:
+            manifest.save()
+finally:
+    manifest.save()   # también si se interrumpe: lo ya procesado no se repite
 
 print("Preprocesamiento finalizado")
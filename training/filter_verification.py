@@ -6,23 +6,29 @@ from sunpy.map import Map
 
 # -------- CONFIGURACIÓN --------
 FITS_DIR = "./../images_intensity/data_hmi_Ic_45s_crop_dr/"
+PRE_CUBE = "./../images_intensity/data_hmi_Ic_45s_crop_dr.npy"  # cubo del preprocesado (OUTPUT_CUBE = "npy")
 RAW_CUBE_NPY = "cube_raw.npy"
 FILTERED_CUBE_NPY = "./../filtering_algorithm/filtered_cube.npy"
 DT = 45.0  # segundos de cadencia
 
 # -------- 1) Leer FITS y crear cubo raw --------
-fits_files = sorted(glob.glob(os.path.join(FITS_DIR, "*.fits")))
-if not fits_files:
-    raise FileNotFoundError(f"No FITS found in {FITS_DIR}")
+# Si el preprocesado escribió el cubo, se usa directamente (sin leer FITS)
+if os.path.exists(PRE_CUBE):
+    RAW_CUBE_NPY = PRE_CUBE
+    print(f"Usando el cubo del preprocesado '{PRE_CUBE}'")
+else:
+    fits_files = sorted(glob.glob(os.path.join(FITS_DIR, "*.fits")))
+    if not fits_files:
+        raise FileNotFoundError(f"No FITS found in {FITS_DIR}")
 
-# Cargar datos de cada FITS en un array
-cube_raw = np.stack([Map(f).data for f in fits_files])  # shape: (T, H, W)
+    # Cargar datos de cada FITS en un array
+    cube_raw = np.stack([Map(f).data for f in fits_files])  # shape: (T, H, W)
 
-np.save(RAW_CUBE_NPY, cube_raw)
-print(f"Cubo raw guardado en '{RAW_CUBE_NPY}' con forma {cube_raw.shape}")
+    np.save(RAW_CUBE_NPY, cube_raw)
+    print(f"Cubo raw guardado en '{RAW_CUBE_NPY}' con forma {cube_raw.shape}")
 
 # -------- 2) Cargar cubo raw y filtrado --------
-cube_raw = np.load(RAW_CUBE_NPY)
+cube_raw = np.load(RAW_CUBE_NPY, mmap_mode="r")
 
 # print("Frames encontrados:", cube_raw.shape[0])
 # print("Dimensiones espacial:", cube_raw.shape[1:], "(H, W)")
@@ -35,7 +41,7 @@ T, H, W = cube_raw.shape
 y0, x0 = H//2, W//2  # pijxel central
 
 # -------- 4) Serie temporal y FFT --------
-signal_raw = cube_raw[:, y0, x0]
+signal_raw = np.array(cube_raw[:, y0, x0], dtype=float)
 signal_filt = cube_filt[:, y0, x0]
 
 # Centrar señales